@@ -0,0 +1,168 @@
+""" The check_correctness of the first version of src/execution.py, kept as
+the baseline of scripts/benchmark_grading.py: every job starts a Manager
+server process and a Process running the testcase in a new temporary
+directory. Only meant to be measured, the grading code is src.execution.
+"""
+
+from typing import Optional, Dict
+import contextlib
+import faulthandler
+import io
+import os
+import multiprocessing
+import platform
+import tempfile
+
+from src.execution import get_autograder_code
+from src.utils.files import write
+
+# The job runs in a closure, which only a forked process can run
+CONTEXT = multiprocessing.get_context("fork")
+
+
+def check_correctness(problem: Dict, completion: str, timeout: float,
+                      completion_id: Optional[int] = None) -> Dict:
+    """
+    Evaluates the functional correctness of a completion by running the test
+    suite provided in the problem.
+    """
+
+    def unsafe_execute():
+
+        with create_tempdir():
+
+            # These system calls are needed when cleaning up tempdir.
+            import os
+            import sys
+            import shutil
+
+            rmtree = shutil.rmtree
+            rmdir = os.rmdir
+            chdir = os.chdir
+            unlink = os.unlink
+
+            # Disable functionalities that can make destructive changes to the test.
+            reliability_guard()
+
+            # adding the temp dir to the path such that autograder.py can be seen
+            sys.path.append("./")
+
+            write(problem["id"] + ".py", problem["code"])
+            write("autograder.py", get_autograder_code())
+            exec_string = create_execution_string(problem["testcase"])
+
+            try:
+                exec_globals = {}
+                stream = io.StringIO()
+                with contextlib.redirect_stdout(stream):
+                    with contextlib.redirect_stderr(stream):
+                        with redirect_stdin(stream):
+                            exec(exec_string, exec_globals)
+                unit_test_result = stream.getvalue()
+                score = get_unit_test_score(unit_test_result)
+                result.append({"exec_result": "completed", "score": score, "text": unit_test_result})
+                assert isinstance(score, float)
+
+            except BaseException as e:
+                result.append({"exec_result": f"failed: {e}", "score": 0, "text": ""})
+
+            # Needed for cleaning up.
+            shutil.rmtree = rmtree
+            os.rmdir = rmdir
+            os.chdir = chdir
+            os.unlink = unlink
+            # remove the temp dir from the path
+            sys.path.pop()
+
+    manager = CONTEXT.Manager()
+    result = manager.list()
+
+    p = CONTEXT.Process(target=unsafe_execute)
+    p.start()
+    p.join(timeout=timeout + 1)
+    if p.is_alive():
+        p.kill()
+
+    if not result:
+        result.append({"exec_result": "timed out", "score": 0, "text": ""})
+
+    return result[0]
+
+
+@contextlib.contextmanager
+def create_tempdir():
+    with tempfile.TemporaryDirectory() as dirname:
+        with chdir(dirname):
+            yield dirname
+
+
+class redirect_stdin(contextlib._RedirectStream):  # type: ignore
+    _stream = 'stdin'
+
+
+@contextlib.contextmanager
+def chdir(root):
+    if root == ".":
+        yield
+        return
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def reliability_guard(maximum_memory_bytes: Optional[int] = None):
+    """ The reliability_guard of the first version, see src.execution. """
+
+    if maximum_memory_bytes is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (maximum_memory_bytes, maximum_memory_bytes))
+        resource.setrlimit(resource.RLIMIT_DATA, (maximum_memory_bytes, maximum_memory_bytes))
+        if not platform.uname().system == 'Darwin':
+            resource.setrlimit(resource.RLIMIT_STACK, (maximum_memory_bytes, maximum_memory_bytes))
+
+    faulthandler.disable()
+
+    import builtins
+    builtins.exit = None
+    builtins.quit = None
+    builtins.help = None
+
+    os.environ['OMP_NUM_THREADS'] = '1'
+
+    for name in ["kill", "system", "putenv", "remove", "removedirs", "rmdir", "fchdir",
+                 "setuid", "fork", "forkpty", "killpg", "rename", "renames", "truncate",
+                 "replace", "unlink", "fchmod", "fchown", "chmod", "chown", "chroot",
+                 "lchflags", "lchmod", "lchown", "getcwd", "chdir"]:
+        setattr(os, name, None)
+
+    import shutil
+    shutil.rmtree = None
+    shutil.move = None
+    shutil.chown = None
+
+    import sys
+    for name in ["ipdb", "joblib", "resource", "psutil", "tkinter"]:
+        sys.modules[name] = None
+
+
+def create_execution_string(testcase):
+    testcase = testcase.replace("from cs110 import autograder", "import autograder")
+    testcase = testcase.replace("if __name__ == '__main__':", "")
+    testcase = testcase.replace("result = test_passed()", "")
+    testcase = testcase.replace('print("Unit Test Returned:", result)', "")
+    testcase = testcase.strip()
+    testcase = testcase + "\nresult = test_passed()\n"
+    testcase = testcase + 'print("Unit Test Returned:", result)'
+
+    return testcase
+
+
+def get_unit_test_score(testcase_output):
+    lines = testcase_output.splitlines()
+    utr = [l for l in lines if l.startswith("Unit Test Returned:")]
+    if utr:
+        return float(utr[0].replace("Unit Test Returned:", "").strip())
+    return 0.0
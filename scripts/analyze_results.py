@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+""" Writes the student outputs and the model score summaries in one pass """
+
+import argparse
+
+import os
+
+from src.analysis import load_many_results, profile_by_problem, stream_aggregates, write_outputs
+from src.data.StudentAggregates import StudentAggregates
+from src.utils.checkpoint import read_jsonl
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Aggregate the model results and the student submissions')
+    parser.add_argument('-r', '--results', nargs='*', default=[], help='the result files of the models (CSV, or JSONL checkpoints)')
+    parser.add_argument('-s', '--submissions', help='the student submissions (falconcode_v1_merged.csv)')
+    parser.add_argument('--store', help='the aggregate store the submissions are folded into, if any')
+    parser.add_argument('-o', '--output-dir', default='outputs', help='the directory to save the outputs')
+    parser.add_argument('-c', '--chunksize', type=int, default=100_000, help='the number of submissions read at a time')
+    parser.add_argument('--all', action='store_true', help='keep the results whose execution did not complete')
+    parser.add_argument('--profile', nargs='*', default=[], help='checkpoints (jsonl) of runs graded with --profile')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results, aggregates = None, None
+    if args.results:
+        results = load_many_results(args.results, completed_only=not args.all)
+    if args.store:
+        # Only the submissions that are new to the store are read
+        with StudentAggregates(args.store) as store:
+            if args.submissions and not store.add_csv(args.submissions, chunksize=args.chunksize):
+                print("No new submissions in", args.submissions)
+            aggregates = store.to_frame()
+    elif args.submissions:
+        aggregates = stream_aggregates(args.submissions, args.chunksize)
+    for path in write_outputs(args.output_dir, results, aggregates):
+        print("Saved", path)
+    if args.profile:
+        profile = profile_by_problem(row for path in args.profile for row in read_jsonl(path))
+        path = os.path.join(args.output_dir, "grading_profile.csv")
+        profile.to_csv(path)
+        print("Saved", path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+""" Measures the per-job latency of the sandbox modes of src.execution """
+
+import time
+import argparse
+import statistics
+
+from benchmarks import baseline_execution
+from src.execution import SandboxPool
+
+
+TESTCASE = '''from cs110 import autograder
+
+# Runs the Python script and sees if it passes the test(s)
+def test_passed():
+    tests_passed = 0
+    for number in [2, 3]:
+        output, error = autograder.run_script("benchmark.py", [number])
+        if output.strip().endswith(str(number * 2)):
+            tests_passed += 1
+    return 50.0 * tests_passed
+
+if __name__ == '__main__':
+    result = test_passed()
+    print("Unit Test Returned:", result)
+'''
+
+PROBLEM = {
+    "id": "benchmark",
+    "code": "number = int(input('Number: '))\nprint(number * 2)\n",
+    "testcase": TESTCASE,
+}
+
+# Options of the SandboxPool of each mode. The baseline is the Manager +
+# Process per job of the first check_correctness (benchmarks/), a restart
+# worker is recycled after each job, the others reuse their processes
+MODES = {
+    "baseline": None,
+    "restart": dict(max_jobs_per_worker=1),
+    "persistent": dict(),
+    "fork": dict(fork=True),
+    "inprocess": dict(fork=True, inprocess=True),
+    # Persistent workers with resource limits, the programs run under prlimit
+    "limited": dict(memory_limit=2 ** 30, cpu_limit=5, output_limit=2 ** 20),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the grading sandbox modes')
+    parser.add_argument('-n', '--n-jobs', type=int, default=50, help='the number of jobs per mode')
+    parser.add_argument('-t', '--timeout', type=float, default=5.0, help='the timeout of each job')
+    parser.add_argument('-m', '--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    
+    return parser.parse_args()
+
+def benchmark(mode, n_jobs, timeout):
+    if MODES[mode] is None:
+        return measure(lambda: baseline_execution.check_correctness(PROBLEM, None, timeout), n_jobs)
+    pool = SandboxPool(n_workers=1, **MODES[mode])
+    try:
+        return measure(lambda: pool.run(PROBLEM, timeout), n_jobs)
+    finally:
+        pool.close()
+
+def measure(run, n_jobs):
+    """ Latencies of n_jobs calls of run, after a first one (which also starts a worker). """
+    latencies = []
+    run()
+    for _ in range(n_jobs):
+        start = time.perf_counter()
+        result = run()
+        latencies.append(time.perf_counter() - start)
+        assert result["exec_result"] == "completed", result
+    return latencies
+
+def main():
+    args = parse_args()
+    print(f"{'mode':<12}{'mean (ms)':>12}{'median (ms)':>14}{'max (ms)':>12}")
+    for mode in args.modes:
+        latencies = [1000 * l for l in benchmark(mode, args.n_jobs, args.timeout)]
+        print(f"{mode:<12}{statistics.mean(latencies):>12.1f}"
+              f"{statistics.median(latencies):>14.1f}{max(latencies):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
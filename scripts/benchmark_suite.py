@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Grades a reproducible synthetic workload built on real FalconCode testcases
+at several worker counts, and writes a JSON report to compare across commits.
+Runs offline: only the sandbox and the student programs are executed.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from src.analysis import profile_by_problem
+from src.execution import check_correctness_many, precompile_testcases
+from src.scheduling import CostModel
+from src.utils.cache import content_hash
+
+
+# Programs graded against every sampled testcase, "correct" uses the
+# recorded programs that got the full score
+PROGRAMS = {
+    "wrong": 'print("wrong answer")\n',
+    "infinite_loop": "while True:\n    pass\n",
+    "print_flood": 'while True:\n    print("flood " * 10)\n',
+    "import_heavy": ("import asyncio, decimal, email.mime.multipart, http.server, json\n"
+                     "import logging, sqlite3, unittest, xml.dom.minidom, statistics\n"
+                     'print("imported")\n'),
+    "input_starved": "while True:\n    input()\n",
+}
+KINDS = ["correct", *PROGRAMS]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark check_correctness on a synthetic workload')
+    parser.add_argument('-p', '--problems', default='outputs/gpt-4_v1_result_new.csv',
+                        help='a CSV with id and testcase columns, and code and score ones for the correct programs')
+    parser.add_argument('-n', '--n-problems', type=int, default=10, help='the number of testcases sampled')
+    parser.add_argument('-k', '--kinds', nargs='+', default=KINDS, choices=KINDS, help='the kinds of programs graded')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4], help='the worker counts benchmarked')
+    parser.add_argument('-t', '--timeout', type=float, default=2.0, help='the timeout of each job')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='the seed of the problem sample')
+    parser.add_argument('-o', '--output', default='benchmark_report.json', help='the JSON report written')
+    parser.add_argument('--fork', action='store_true', help='use fork-server sandbox workers')
+    parser.add_argument('--inprocess', action='store_true', help='run the student programs in the sandbox process')
+    parser.add_argument('--profile', action='store_true', help='add the problems taking the most grading time to the report')
+    parser.add_argument('--schedule', action='store_true',
+                        help='grade the longest expected jobs first with per-problem timeouts, learnt over the runs')
+
+    return parser.parse_args()
+
+def build_workload(path, n_problems, kinds, seed):
+    """ The jobs (problem rows with a kind column), the same for the same arguments and file. """
+    df = pd.read_csv(path, usecols=lambda column: column in ("id", "testcase", "code", "score", "max_score"))
+    df = df[df["testcase"].notna()].drop_duplicates("id").sort_values("id")
+    invalid = precompile_testcases(df["testcase"])
+    df = df[[content_hash(testcase) not in invalid for testcase in df["testcase"]]]
+    sample = random.Random(seed).sample(list(df["id"]), min(n_problems, len(df)))
+    df = df.set_index("id")
+
+    jobs = []
+    for problem_id in sorted(sample):
+        row = df.loc[problem_id]
+        for kind in kinds:
+            if kind == "correct":
+                max_score = row["max_score"] if "max_score" in row else 100
+                if "code" not in row or not isinstance(row["code"], str) or row["score"] < max_score:
+                    continue
+                code = row["code"]
+            else:
+                code = PROGRAMS[kind]
+            jobs.append({"id": problem_id, "testcase": row["testcase"], "code": code, "kind": kind})
+    return jobs
+
+def count_processes():
+    """ Processes created on the machine since boot, None where /proc/stat is missing. """
+    try:
+        with open("/proc/stat") as fp:
+            for line in fp:
+                if line.startswith("processes "):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentiles(values):
+    if not len(values):
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": float(np.mean(values)), "p50": float(p50), "p95": float(p95),
+            "p99": float(p99), "max": float(np.max(values))}
+
+def run(jobs, n_workers, timeout, options, cost_model=None):
+    """
+    Grades the jobs once on a new pool of n_workers, returns the measures.
+    The jobs are ordered and given timeouts by the cost model, when given.
+    """
+    dispatched, latencies, results, timeouts = {}, {}, {}, {}
+
+    def problems():
+        scheduled = [dict(job, completion_id=i) for i, job in enumerate(jobs)]
+        if cost_model is not None:
+            scheduled = cost_model.schedule(scheduled)
+        # A problem is pulled right before it is submitted to an idle worker
+        for problem in scheduled:
+            dispatched[problem["completion_id"]] = time.perf_counter()
+            timeouts[problem["completion_id"]] = problem.get("timeout", timeout)
+            yield problem
+
+    processes = count_processes()
+    start = time.perf_counter()
+    for result in check_correctness_many(problems(), timeout, n_workers=n_workers, **options):
+        i = result["completion_id"]
+        latencies[i] = time.perf_counter() - dispatched[i]
+        results[i] = result
+        if cost_model is not None:
+            cost_model.observe(jobs[i]["id"], result, timeouts[i])
+    wall = time.perf_counter() - start
+    spawned = count_processes() - processes if processes is not None else None
+
+    by_kind = {}
+    for kind in dict.fromkeys(job["kind"] for job in jobs):
+        ids = [i for i, job in enumerate(jobs) if job["kind"] == kind]
+        outcomes = pd.Series([results[i]["exec_result"].split(":")[0] for i in ids]).value_counts()
+        by_kind[kind] = {"n": len(ids), "latency": percentiles([latencies[i] for i in ids]),
+                         "mean_score": float(np.mean([results[i]["score"] for i in ids])),
+                         "exec_results": {k: int(v) for k, v in outcomes.items()}}
+    peaks = [result["worker_peak_rss"] for result in results.values() if result.get("worker_peak_rss")]
+    program_peaks = [result["peak_rss"] for result in results.values() if result.get("peak_rss")]
+    measures = {
+        "n_workers": n_workers,
+        "n_jobs": len(jobs),
+        "wall_seconds": wall,
+        "completions_per_second": len(jobs) / wall,
+        "latency": percentiles(list(latencies.values())),
+        "processes_spawned": spawned,
+        "peak_rss_sandbox": max(peaks) if peaks else None,
+        "peak_rss_program": percentiles(program_peaks),
+        "cpu_seconds": float(sum(result.get("cpu_seconds") or 0 for result in results.values())),
+        "by_kind": by_kind,
+    }
+    if options.get("profile"):
+        profile = profile_by_problem(dict(results[i], id=job["id"]) for i, job in enumerate(jobs))
+        measures["profile"] = json.loads(profile.head(10).to_json(orient="index"))
+    return measures
+
+def resource_peak():
+    """ Peak resident memory (bytes) of this process and of its reaped children. """
+    scale = 1 if platform.system() == "Darwin" else 1024
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = parse_args()
+    jobs = build_workload(args.problems, args.n_problems, args.kinds, args.seed)
+    options = {k: True for k in ("fork", "inprocess", "profile") if getattr(args, k)}
+    cost_model = CostModel(default_timeout=args.timeout) if args.schedule else None
+    print("Number of jobs", len(jobs))
+
+    runs = []
+    for n_workers in args.workers:
+        measures = run(jobs, n_workers, args.timeout, options, cost_model)
+        latency = measures["latency"]
+        print(f"workers {n_workers}: {measures['completions_per_second']:.1f} jobs/s, "
+              f"p50 {1000 * latency['p50']:.0f} ms, p95 {1000 * latency['p95']:.0f} ms, "
+              f"p99 {1000 * latency['p99']:.0f} ms, {measures['processes_spawned']} processes")
+        runs.append(measures)
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"problems": args.problems, "n_problems": args.n_problems, "kinds": args.kinds,
+                     "timeout": args.timeout, "seed": args.seed, "schedule": args.schedule,
+                     **options},
+        "workload": {"n_jobs": len(jobs),
+                     "digest": content_hash(*[(job["id"], job["kind"], job["code"]) for job in jobs]),
+                     "kinds": {kind: sum(job["kind"] == kind for job in jobs) for kind in args.kinds}},
+        "peak_rss_parent": resource_peak(),
+        "runs": runs,
+    }
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+    print("Report saved to", args.output)
+
+
+if __name__ == "__main__":
+    main()
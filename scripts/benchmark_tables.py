@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Checks that the native table renderer reproduces the pandas rendering of
+every table in the FalconCode prompts, and measures the speedup.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import pandas as pd
+from bs4 import BeautifulSoup
+
+from src.utils.tables import render_table
+from src.utils.TableConverter import pandas_table
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the native and pandas table renderers')
+    parser.add_argument('-i', '--input-dir', required=True, help='the directory containing falconcode_v1_table_problems.csv')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='the number of timed passes over the tables')
+    parser.add_argument('-s', '--show', type=int, default=5, help='the number of mismatches to print')
+
+    return parser.parse_args()
+
+def load_tables(input_dir):
+    df = pd.read_csv(os.path.join(input_dir, "falconcode_v1_table_problems.csv"))
+    df = df.drop_duplicates("id").fillna("")
+    # Parsed like markdownify does before calling convert_table
+    return [(problem_id, table)
+            for problem_id, prompt in df[["id", "prompt"]].to_numpy()
+            for table in BeautifulSoup(prompt, "html.parser").find_all("table")]
+
+def timed(render, tables, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _, table in tables:
+            render(table)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def native_table(el):
+    table = render_table(el)
+    return table if table is not None else pandas_table(el)
+
+def main():
+    args = parse_args()
+    tables = load_tables(args.input_dir)
+    print("Number of tables", len(tables))
+
+    native, fallbacks, mismatches = 0, 0, []
+    for problem_id, table in tables:
+        expected = pandas_table(table)
+        rendered = render_table(table)
+        if rendered is None:
+            fallbacks += 1
+        elif rendered == expected:
+            native += 1
+        else:
+            mismatches.append((problem_id, expected, rendered))
+    print(f"Rendered natively {native}, fallbacks {fallbacks}, mismatches {len(mismatches)}")
+    for problem_id, expected, rendered in mismatches[:args.show]:
+        print(f"--- {problem_id} pandas\n{expected}\n--- {problem_id} native\n{rendered}")
+
+    pandas_time = timed(pandas_table, tables, args.repeat)
+    native_time = timed(native_table, tables, args.repeat)
+    print(f"pandas {1000 * pandas_time:.1f} ms, native {1000 * native_time:.1f} ms "
+          f"(x{pandas_time / max(native_time, 1e-9):.1f})")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
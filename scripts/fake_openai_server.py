@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+""" Local OpenAI compatible server to exercise the generation pipeline offline.
+
+Answers every chat completion with a fixed program, optionally after some
+latency and with a fraction of rate limit errors.
+"""
+
+import json
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+ANSWER = "```python\nprint('Hello, World!')\n```"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve fake OpenAI chat completions')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='the port to listen on')
+    parser.add_argument('-l', '--latency', type=float, default=0.5, help='the seconds taken by each answer')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0, help='the fraction of 429 answers')
+    
+    return parser.parse_args()
+
+def make_handler(latency, error_rate):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(latency)
+            if random.random() < error_rate:
+                status = 429
+                body = {"error": {"message": "Rate limit reached", "type": "requests"}}
+            else:
+                status = 200
+                n = request.get("n", 1)
+                body = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [{"index": i, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": ANSWER}}
+                                for i in range(n)],
+                    "usage": {"prompt_tokens": 100, "completion_tokens": 20 * n,
+                              "total_tokens": 100 + 20 * n},
+                }
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def main():
+    args = parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port),
+                                 make_handler(args.latency, args.error_rate))
+    print(f"Serving fake completions on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,52 +10,88 @@ def parse_args():
     parser.add_argument('-i', '--input-dir', required=True, help='the directory to save result.csv file')
     parser.add_argument('-c', '--config', help='the configuration', default='config/v1.json')
     parser.add_argument('-v', '--validity', help='the valid ones', default='config/validity.json')
+    parser.add_argument('-s', '--chunksize', type=int, default=100_000, help='the number of submissions read at a time')
     
     return parser.parse_args()
 
+def extract_skeleton(sample):
+    skeleton, limit = "", "#Your code goes here."
+    if limit in sample:
+        skeleton = sample[:sample.find(limit) + len(limit)]
+    return skeleton
+
 def find_skeletons(merged_df):
     df = merged_df.drop_duplicates("problem_id")
     id_to_skeleton = dict()
     for problem_id, sample in df[["problem_id", "source_code"]].to_numpy():
-        skeleton, limit = "", "#Your code goes here."
-        if limit in sample:
-            skeleton = sample[:sample.find(limit) + len(limit)]
-        id_to_skeleton[problem_id] = skeleton
+        id_to_skeleton[problem_id] = extract_skeleton(sample)
         
     return id_to_skeleton
 
+def stream_skeletons(path, problem_ids=None, chunksize=100_000):
+    """
+    Same result as find_skeletons(process_merged_df(pd.read_csv(path))), the
+    skeleton of a problem being taken from its first submission, but the
+    merged submissions are read in chunks of the two needed columns. Problems
+    whose skeleton is known are dropped from the following chunks, and the
+    reading stops early once all the given problem_ids are found.
+    """
+    id_to_skeleton = dict()
+    remaining = None if problem_ids is None else set(problem_ids)
+    chunks = pd.read_csv(path, usecols=["problem_id", "source_code"],
+                         dtype=str, chunksize=chunksize)
+    for chunk in chunks:
+        problem_ids = chunk["problem_id"].str.replace("####", "_", regex=False)
+        chunk = chunk.assign(problem_id=problem_ids).drop_duplicates("problem_id")
+        chunk = chunk[~chunk["problem_id"].isin(id_to_skeleton)]
+        for problem_id, sample in zip(chunk["problem_id"], chunk["source_code"].fillna("")):
+            id_to_skeleton[problem_id] = extract_skeleton(sample)
+        if remaining is not None:
+            remaining.difference_update(chunk["problem_id"])
+            if not remaining:
+                break
+
+    return id_to_skeleton
+
 def process_merged_df(df):
     df["source_code"] = df["source_code"].fillna("")
     df["concept_list"] = df["concept_list"].fillna("")
-    df["problem_id"] = [pid.replace("####", "_") for pid in df["problem_id"]]
-    df["concept_list"] = [pid.replace("####", "_") for pid in df["concept_list"]]
+    df["problem_id"] = df["problem_id"].str.replace("####", "_", regex=False)
+    df["concept_list"] = df["concept_list"].str.replace("####", "_", regex=False)
     df = df.drop(columns=["id", "Unnamed: 0"])
     return df
 
 def process_problems_df(df, problems_df):
-    id_to_skeleton = find_skeletons(df)
-    problems_df["skeleton"] = [id_to_skeleton.get(pid, "")
-                               for pid in problems_df["id"]]
+    return add_skeletons(problems_df, find_skeletons(df))
+
+def add_skeletons(problems_df, id_to_skeleton):
+    problems_df["skeleton"] = problems_df["id"].map(id_to_skeleton).fillna("")
     return problems_df 
 
+def load_problems(args):
+    path = os.path.join(args.input_dir, "falconcode_v1_table_problems.csv")
+    return pd.read_csv(path)
+
 def load_datasets(args):
     path = os.path.join(args.input_dir, "falconcode_v1_merged.csv")
     merged_df = pd.read_csv(path)
-    path = os.path.join(args.input_dir, "falconcode_v1_table_problems.csv")
-    problems_df = pd.read_csv(path)
+    problems_df = load_problems(args)
     
     return merged_df, problems_df
 
-def save_datasets(args, df, problems_df):
+def save_datasets(args, problems_df):
     save_path = os.path.join(args.input_dir, "falconcode_v1_table_problems_updated.csv")
     problems_df.to_csv(save_path)
     
 def main():
     args = parse_args()
-    df, problems_df = load_datasets()
-    df = process_merged_df(df)
-    problems_df = process_problems_df(df, problems_df)
-    save_datasets(df, problems_df)
+    problems_df = load_problems(args)
+    # The merged submissions table grows with every semester, it is streamed
+    # instead of being loaded with load_datasets
+    path = os.path.join(args.input_dir, "falconcode_v1_merged.csv")
+    id_to_skeleton = stream_skeletons(path, problems_df["id"], args.chunksize)
+    problems_df = add_skeletons(problems_df, id_to_skeleton)
+    save_datasets(args, problems_df)
     
 
 if __name__ == "__main__":
@@ -2,13 +2,21 @@
 
 import os
 import time
+import asyncio
 import argparse
 import html2text
 
 import openai
-import pandas as pd
 
-from src.execution import check_correctness
+from src.data.Falcon import Falcon
+from src.execution import SandboxPool, check_correctness, precompile_testcases, set_default_pool
+from src.extraction import extract_code
+from src.generation import GenerationEngine
+from src.pipeline import Pipeline
+from src.prescreen import check_screened
+from src.scheduling import CostModel
+from src.utils.cache import Cache
+from src.utils.checkpoint import Checkpoint, read_jsonl
 from src.utils.files import json2data
 from tqdm import tqdm 
 
@@ -18,23 +26,23 @@ def save_generation_results(dataframe, args):
     os.makedirs(args.output_dir, exist_ok=True)
     print(f'successfully ensured directory existence')
 
-    config_version = args.config.split("config/")[1].split(".json")[0]
-    filename = f"{args.model}_{config_version}_result_new.csv"
-    result_filename = os.path.join(args.output_dir, filename)
+    result_filename = get_result_filename(args)
     print("Saving results to ", result_filename)
     dataframe.to_csv(result_filename)
 
 
-def getConcepts(problem_id, df):
+def get_result_filename(args, extension="csv"):
+    config_version = args.config.split("config/")[1].split(".json")[0]
+    filename = f"{args.model}_{config_version}_result_new.{extension}"
+    return os.path.join(args.output_dir, filename)
+
+
+def getConcepts(problem_id, index):
     """ 
         return a list of concepts that required for solving this problem 
+        (index is a ConceptIndex built once over the problems DataFrame)
     """
-    concept_list = ['input_str', 'input_cast', 'output', 'assignment', 'conditional',
-       'function_call', 'function_def', 'function_return', 'loop_counting',
-       'loop_until', 'loop_elements', 'loop_nested', 'stat_calculate',
-       'file_read', 'file_write', 'list', 'list_2d', 'dictionary', 'item_set',
-       'tuple']
-    return [concept for concept in concept_list if (df[df['id']==problem_id][concept].iloc[0]==1)]
+    return index.concepts_of(problem_id)
 
 
 def generatePropmt(problem_description, skeleton_code):
@@ -48,16 +56,6 @@ def generatePropmt(problem_description, skeleton_code):
 
     return prompt
 
-def extractResultCode(raw_result):
-    """
-    cleaning the generated code format
-    """
-    if raw_result[:9] == "```python":
-        raw_result = raw_result.split("```python")[1]
-    if raw_result[-3:] == "```":
-        raw_result = raw_result.split("```")[0]
-    return raw_result
-
 def generateGPTAnswer(prompt, api_key=os.environ.get('OPEN_AI_KEY', None), model="gpt-3.5-turbo"):
     """
     input: prompt, problem_description, student_code
@@ -93,62 +91,143 @@ def generateGPTAnswer(prompt, api_key=os.environ.get('OPEN_AI_KEY', None), model
     return gpt_code
 
 
-def get_results(problems_df, model):
-    print("problems dataframe", problems_df)
+def missing_samples(problem_id, checkpoint, n_samples):
+    """ Indices of the samples of a problem that are not in the checkpoint yet """
+    return [sample for sample in range(n_samples) if (problem_id, sample) not in checkpoint]
 
-    results = []
-    for i in tqdm(range(len(problems_df))):
+
+def iter_rows(problems_df, model, checkpoint, n_samples):
+    """ Lazily builds the rows sent to the model, one per problem """
+    for i in range(len(problems_df)):
         row = problems_df.iloc[i].to_dict()
         problem_description = html2text.html2text(row['prompt'])
         row["prompt"] = generatePropmt(problem_description, row['skeleton'])
         row["model"] = model
-        try: 
-            gpt_answser = generateGPTAnswer(row["prompt"], model=model)
-            row["code"] = extractResultCode(gpt_answser)
-            output = check_correctness(row, timeout=5.0, completion=None)
-            row.update(output)
-            
-        except openai.error.ServiceUnavailableError:
-            print("Service unavailable, trying again")
-            continue
-        except openai.error.RateLimitError:
-            print("No moneey")
-            time.sleep(1)
-            exit()
-
-        results.append(row)
-        
-    result_df = pd.DataFrame(results)
+        row["samples"] = missing_samples(row["id"], checkpoint, n_samples)
+        yield row
 
-    return result_df
 
+def get_results(problems_df, engine, checkpoint, n_samples=1, cache=None, cost_model=None,
+                prescreen=False):
+    """
+    Generates n_samples programs for each problem, grades them, and appends
+    every finished sample to the checkpoint. Returns the number of samples done.
+    The problems expected to take the longest to grade go first, each with
+    the timeout of the cost model. With prescreen, the programs that do not
+    parse are scored without the sandbox once their testcase was shown to
+    score such a program 0, see src.prescreen.
+    """
+    cost_model = cost_model or CostModel()
+    problems = problems_df[["id", "testcase"]].to_dict("records")
+    costs = [cost_model.expected_seconds(problem) for problem in problems]
+    problems_df = problems_df.iloc[sorted(range(len(problems)), key=lambda i: -costs[i])]
+    print("problems dataframe", problems_df)
 
+    progress = tqdm(total=len(problems_df) * n_samples)
 
-def query_openai(problems_df, args):
-    dataframe = []
-    remaining, n_trials = len(problems_df),  3
-    while remaining > 0 and n_trials > 0:
-        result_df = get_results(problems_df, args.model)
-        remaining -= len(result_df)
-        dataframe.append(result_df)
-        problems_df = problems_df[~problems_df['id'].isin(result_df["id"])]
-        print("Remaining", remaining, "n_trials", n_trials)
-        print("sleeping before trying again")
-        time.sleep(60)
+    async def generate(row):
+        samples = row.pop("samples")
+        try:
+            gpt_answers = await engine.generate_many(row["prompt"], len(samples))
+        except openai.error.OpenAIError as e:
+            print("Generation failed for", row["id"], e)
+            return None
+        return [dict(row, sample=sample, code=extract_code(gpt_answer, row["id"] + ".py"))
+                for sample, gpt_answer in zip(samples, gpt_answers)]
+
+    def grade(row):
+        row["timeout"] = cost_model.timeout(row)
+        check = check_screened if prescreen else check_correctness
+        row.update(check(row, None, row["timeout"], cache=cache))
+        cost_model.observe(row["id"], row)
+        return row
 
-    dataframe = pd.concat(dataframe, axis=0, ignore_index=True)
-    return dataframe
+    def write(row):
+        checkpoint.append(row)
+        progress.update()
 
+    pipeline = Pipeline(generate, grade, write, n_generators=engine.concurrency,
+                        grade_priority=lambda row: -cost_model.expected_seconds(row))
+    asyncio.run(pipeline.run(iter_rows(problems_df, engine.model, checkpoint, n_samples)))
+    progress.close()
+    print("pipeline", pipeline.metrics())
 
+    return progress.n
+
+
+
+def query_openai(problems_df, args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = get_result_filename(args, "jsonl")
+    checkpoint = Checkpoint(results_path, resume=args.resume, restart=args.restart,
+                            key=lambda row: (row["id"], row.get("sample", 0)))
+    if args.resume:
+        print("Resuming,", len(checkpoint.keys), "samples already done")
+    n_trials = 3
+    cache = Cache(args.cache) if args.cache else None
+    # Timings of the samples already graded refine the costs and timeouts
+    cost_model = CostModel()
+    if args.resume and os.path.exists(results_path):
+        cost_model.observe_results(read_jsonl(results_path))
+    engine = GenerationEngine(args.model, concurrency=args.concurrency,
+                              requests_per_minute=args.rpm,
+                              tokens_per_minute=args.tpm,
+                              api_base=args.api_base)
+    if args.memory_limit or args.cpu_limit or args.output_limit or args.keep_text or args.profile:
+        set_default_pool(SandboxPool(os.cpu_count() or 1, memory_limit=args.memory_limit,
+                                     cpu_limit=args.cpu_limit, output_limit=args.output_limit,
+                                     keep_text=args.keep_text, profile=args.profile))
+    # Testcases are rewritten and compiled once, the sandbox workers get the code objects
+    invalid = precompile_testcases(problems_df["testcase"])
+    if invalid:
+        print("Invalid testcases", len(invalid), set(invalid.values()))
+    with checkpoint:
+        while n_trials > 0:
+            problems_df = problems_df[[bool(missing_samples(pid, checkpoint, args.n_samples))
+                                       for pid in problems_df['id']]]
+            print("Remaining", len(problems_df), "n_trials", n_trials)
+            if not len(problems_df):
+                break
+            if n_trials < 3:
+                print("sleeping before trying again")
+                time.sleep(60)
+            get_results(problems_df, engine, checkpoint, args.n_samples, cache, cost_model,
+                        args.prescreen)
+            n_trials -= 1
+
+    return results_path
+
+
+
+
+def load_dataset(args):
+    """ The preprocessed problems, with their skeletons (see scripts/preprocessing.py). """
+    return Falcon(args.input_dir).load_dataset
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Call chatGPT-3.5 api to generate code and save into a csv file.')
     parser.add_argument('-m', '--model', help='the model used to generate the code', default='gpt-3.5-turbo')
-    parser.add_argument('-i', '--input-dir', required=True, help='the directory to save result.csv file')
+    parser.add_argument('-i', '--input-dir', required=True, help='the directory containing falconcode_v1_table_problems_updated.csv')
     parser.add_argument('-o', '--output-dir',  required=True, help='the directory to save result.csv file')
     parser.add_argument('-c', '--config', help='the configuration', default='config/v1.json')
     parser.add_argument('-v', '--validity', help='the valid ones', default='config/validity.json')
+    parser.add_argument('--cache', help='the sqlite file caching grading results', default=None)
+    parser.add_argument('--concurrency', type=int, default=16, help='the maximum number of concurrent requests')
+    parser.add_argument('--rpm', type=float, default=3500, help='the requests per minute limit of the account')
+    parser.add_argument('--tpm', type=float, default=90000, help='the tokens per minute limit of the account')
+    parser.add_argument('--api-base', default=None, help='the OpenAI compatible server to query')
+    parser.add_argument('--resume', action='store_true', help='skip the samples already in the results file')
+    parser.add_argument('--restart', action='store_true',
+                        help='start a new results file, an existing one is renamed aside (.bak)')
+    parser.add_argument('-n', '--n-samples', type=int, default=1, help='the number of programs generated per problem')
+    parser.add_argument('--memory-limit', type=int, default=None, help='the address space limit (bytes) of the graded programs')
+    parser.add_argument('--cpu-limit', type=float, default=None, help='the CPU time limit (seconds) of each grading job')
+    parser.add_argument('--output-limit', type=int, default=None, help='the output limit (characters) of the graded programs')
+    parser.add_argument('--keep-text', action='store_true', help='save the output of the testcases with the results')
+    parser.add_argument('--profile', action='store_true', help='save the timings of the grading phases with the results')
+    parser.add_argument('--prescreen', action='store_true',
+                        help='score the programs that do not parse without the sandbox when their testcase scores them 0, and flag likely failures')
     
     return parser.parse_args()
 
@@ -157,8 +236,8 @@ def main():
     problems_df = load_dataset(args)
     # Temporary
     problems_df = problems_df.head(1)
-    dataframe = query_openai(problems_df, args)
-    # save_generation_results(dataframe, args)
+    results_path = query_openai(problems_df, args)
+    # save_generation_results(pd.DataFrame(read_jsonl(results_path)), args)
     
 
 if __name__ == '__main__':
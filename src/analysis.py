@@ -0,0 +1,211 @@
+""" Aggregated scores of the models and of the students.
+
+The result files produced by scripts/run_openai.py carry the full prompt,
+testcase and code of every problem, only the numeric and categorical columns
+are read here. Student submissions are reduced to sums and counts per
+(student, problem, type) once, and every student output is derived from them.
+"""
+
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.data.ConceptIndex import CONCEPTS
+from src.utils.checkpoint import read_jsonl
+
+RESULT_COLUMNS = ["id", "type", "model", "exec_result", "score", *CONCEPTS]
+SUBMISSION_COLUMNS = ["student_id", "problem_id", "type", "score"]
+# Column order of the barchart outputs
+TYPES = ["project", "lab", "skill"]
+
+
+def load_results(path, model: Optional[str] = None, completed_only: bool = True,
+                 correct_score: float = 100) -> pd.DataFrame:
+    """
+    Reads the score related columns of a result file, a CSV or a JSONL
+    checkpoint of scripts/run_openai.py. The model column is set to model
+    when given (or missing from the file), and the rows whose execution did
+    not complete are dropped unless completed_only is False.
+    """
+    if str(path).endswith(".jsonl"):
+        # Only the needed fields of each row are kept, not the prompts and code
+        df = pd.DataFrame.from_records(
+            [{column: value for column, value in row.items() if column in RESULT_COLUMNS}
+             for row in read_jsonl(path)])
+    else:
+        df = pd.read_csv(path, usecols=lambda column: column in RESULT_COLUMNS)
+    if model is not None or "model" not in df.columns:
+        df["model"] = model if model is not None else os.path.basename(path).split("_")[0]
+    if completed_only:
+        # The prescreened programs are the ones the sandbox completes with 0
+        df = df[(df["exec_result"] == "completed") | df["exec_result"].str.startswith("prescreened")]
+    df = df.drop(columns="exec_result")
+    df["correct"] = df["score"].to_numpy() >= correct_score
+    for column in ["type", "model"]:
+        df[column] = df[column].astype("category")
+    return df.reset_index(drop=True)
+
+
+def load_many_results(paths: Iterable[str], **options) -> pd.DataFrame:
+    frames = [load_results(path, **options) for path in paths]
+    df = pd.concat(frames, ignore_index=True)
+    for column in ["type", "model"]:
+        df[column] = df[column].astype("category")
+    return df
+
+
+def scores_by(results: pd.DataFrame, by) -> pd.DataFrame:
+    """ Mean score, success rate and number of results per group. """
+    return (results.groupby(by, observed=True)
+            .agg(score=("score", "mean"), success_rate=("correct", "mean"),
+                 n=("score", "size")))
+
+
+def scores_by_concept(results: pd.DataFrame, by="model") -> pd.DataFrame:
+    """
+    Mean score, success rate and number of results over the problems
+    requiring each concept, per group. Computed as products of the concept
+    flag matrix with the scores instead of one filter per concept.
+    """
+    concepts = [concept for concept in CONCEPTS if concept in results.columns]
+    rows = []
+    for key, group in results.groupby(by, observed=True):
+        flags = (group[concepts].to_numpy() == 1).astype(np.float64)
+        n = flags.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            score = flags.T @ group["score"].to_numpy(dtype=np.float64) / n
+            success_rate = flags.T @ group["correct"].to_numpy(dtype=np.float64) / n
+        rows.append(pd.DataFrame({by: key, "concept": concepts, "score": score,
+                                  "success_rate": success_rate, "n": n.astype(np.int64)}))
+    return pd.concat(rows, ignore_index=True).set_index([by, "concept"])
+
+
+def aggregate_submissions(submissions: pd.DataFrame, correct_score: float = 100) -> pd.DataFrame:
+    """
+    Sums and counts of the submission scores per (student, problem, type),
+    the building block of all the student outputs.
+    """
+    scores = submissions["score"].to_numpy(dtype=np.float64)
+    df = pd.DataFrame({"student_id": submissions["student_id"].to_numpy(),
+                       "problem_id": submissions["problem_id"].to_numpy(),
+                       "type": submissions["type"].to_numpy(),
+                       "score_sum": scores, "n_success": scores >= correct_score})
+    return (df.groupby(["student_id", "problem_id", "type"], observed=True)
+            .agg(score_sum=("score_sum", "sum"), n_success=("n_success", "sum"),
+                 n=("score_sum", "size")))
+
+
+def stream_aggregates(path, chunksize: int = 100_000, correct_score: float = 100) -> pd.DataFrame:
+    """ aggregate_submissions over a submissions CSV read in chunks of the needed columns. """
+    chunks = pd.read_csv(path, usecols=SUBMISSION_COLUMNS, chunksize=chunksize,
+                         dtype={"student_id": str, "problem_id": str, "type": str})
+    partials = [aggregate_submissions(chunk, correct_score) for chunk in chunks]
+    return pd.concat(partials).groupby(level=[0, 1, 2], observed=True).sum()
+
+
+def student_outputs(aggregates: pd.DataFrame) -> dict:
+    """
+    The student outputs, by file name, derived from the aggregates: per
+    problem (scatterplot), per student (curveplot) and per type (barchart)
+    mean score and success rate over all submissions.
+    """
+    problems = aggregates.groupby(level=["problem_id", "type"], observed=True).sum()
+    problems = problems.reset_index(level="type")
+    students = aggregates.groupby(level="student_id").sum()
+    types = aggregates.groupby(level="type").sum()
+    types = types.loc[[t for t in TYPES if t in types.index]]
+
+    return {
+        "scatterplot_avg_score_student_data.csv": pd.DataFrame({
+            "problem_id": problems.index, "student_avg_score": problems.score_sum / problems.n,
+            "type": problems.type}).reset_index(drop=True),
+        "scatterplot_success_rate_student_data.csv": pd.DataFrame({
+            "problem_id": problems.index, "success_rate": problems.n_success / problems.n,
+            "type": problems.type}).reset_index(drop=True),
+        "curveplot_avg_by_type_student_data.csv": pd.DataFrame({
+            "student_id": students.index, "score": students.score_sum / students.n}).reset_index(drop=True),
+        "curveplot_success_rate_by_type_student_data.csv": pd.DataFrame({
+            "student_id": students.index, "success_rate": students.n_success / students.n}).reset_index(drop=True),
+        "barchart_avg_by_type_student_data.csv": pd.DataFrame(
+            [{f"{t}_avg_score": row.score_sum / row.n for t, row in types.iterrows()}]),
+        "barchart_success_rate_by_type_student_data.csv": pd.DataFrame(
+            [{f"{t}_avg_score": row.n_success / row.n for t, row in types.iterrows()}]),
+    }
+
+
+def load_student_scores(output_dir) -> pd.DataFrame:
+    """ Per problem student mean score and success rate, from the scatterplot outputs. """
+    avg = pd.read_csv(os.path.join(output_dir, "scatterplot_avg_score_student_data.csv"),
+                      usecols=["problem_id", "student_avg_score", "type"])
+    success = pd.read_csv(os.path.join(output_dir, "scatterplot_success_rate_student_data.csv"),
+                          usecols=["problem_id", "success_rate"])
+    success = success.rename(columns={"success_rate": "student_success_rate"})
+    return avg.merge(success, on="problem_id")
+
+
+def compare_with_students(results: pd.DataFrame, student_scores: pd.DataFrame) -> pd.DataFrame:
+    """
+    Mean score and success rate of each model on each problem, joined with
+    the student scores of the problem on problem_id.
+    """
+    per_problem = scores_by(results, ["model", "id"]).reset_index()
+    per_problem = per_problem.rename(columns={"id": "problem_id", "score": "llm_score",
+                                              "success_rate": "llm_success_rate"})
+    return per_problem.merge(student_scores, on="problem_id")
+
+
+def profile_by_problem(results) -> pd.DataFrame:
+    """
+    Per problem profile of grading results made with profile=True (dicts or
+    a DataFrame with id and profile columns, e.g. run_openai checkpoint
+    rows): number of jobs, mean seconds of each phase and total grading
+    seconds with their share, the problems dominating grading first.
+    """
+    rows = results.to_dict("records") if isinstance(results, pd.DataFrame) else results
+    profiles = pd.DataFrame([dict(row["profile"], id=row["id"]) for row in rows
+                             if isinstance(row.get("profile"), dict)])
+    if profiles.empty:
+        return profiles
+    grouped = profiles.groupby("id")
+    profile = grouped.mean()
+    profile.insert(0, "n", grouped.size())
+    # The round trip is measured by the parent, it includes the worker starts
+    total = "round_trip" if "round_trip" in profiles.columns else "testcase"
+    profile["total"] = grouped[total].sum()
+    profile["share"] = profile["total"] / profile["total"].sum()
+    return profile.sort_values("total", ascending=False)
+
+
+def write_outputs(output_dir, results: Optional[pd.DataFrame] = None,
+                  aggregates: Optional[pd.DataFrame] = None) -> list:
+    """
+    Writes the student outputs (when aggregates are given) and the model
+    summaries (when results are given) in one go, returns the written paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    frames = {}
+    if aggregates is not None:
+        frames.update(student_outputs(aggregates))
+    if results is not None:
+        frames["llm_scores_by_type.csv"] = scores_by(results, ["model", "type"])
+        frames["llm_scores_by_concept.csv"] = scores_by_concept(results)
+        if aggregates is not None:
+            student_scores = frames["scatterplot_avg_score_student_data.csv"].merge(
+                frames["scatterplot_success_rate_student_data.csv"]
+                .drop(columns="type").rename(columns={"success_rate": "student_success_rate"}),
+                on="problem_id")
+        elif os.path.exists(os.path.join(output_dir, "scatterplot_avg_score_student_data.csv")):
+            student_scores = load_student_scores(output_dir)
+        else:
+            student_scores = None
+        if student_scores is not None:
+            frames["llm_vs_student_scores.csv"] = compare_with_students(results, student_scores)
+
+    paths = []
+    for filename, frame in frames.items():
+        path = os.path.join(output_dir, filename)
+        frame.to_csv(path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,75 @@
+""" Precomputed lookup of the programming concepts required by each problem """
+
+import numpy as np
+import pandas as pd
+
+# Concept flag columns of the FalconCode problems table
+CONCEPTS = ['input_str', 'input_cast', 'output', 'assignment', 'conditional',
+            'function_call', 'function_def', 'function_return', 'loop_counting',
+            'loop_until', 'loop_elements', 'loop_nested', 'stat_calculate',
+            'file_read', 'file_write', 'list', 'list_2d', 'dictionary', 'item_set',
+            'tuple']
+
+class ConceptIndex():
+    """
+    Maps problem ids to rows of a packed boolean matrix of concept flags
+    (one bit per concept, a flag is set when the column equals 1).
+    Lookups are O(1) per problem and queries are vectorized over all problems.
+    """
+
+    def __init__(self, df, concepts=CONCEPTS, id_column="id") -> None:
+        self.concepts = list(concepts)
+        self.ids = np.asarray(df[id_column])
+        self.rows = {problem_id: row for row, problem_id in enumerate(self.ids)}
+        self.positions = {concept: i for i, concept in enumerate(self.concepts)}
+        flags = (df[self.concepts] == 1).to_numpy()
+        self.bits = np.packbits(flags, axis=1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, problem_id):
+        return problem_id in self.rows
+
+    def pack(self, concepts):
+        """ Packed bit mask of the given concepts, raises KeyError on unknown ones. """
+        flags = np.zeros(len(self.concepts), dtype=bool)
+        flags[[self.positions[concept] for concept in concepts]] = True
+        return np.packbits(flags)
+
+    def flags(self, problem_id):
+        """ Boolean vector of the concepts required by the problem. """
+        row = self.bits[self.rows[problem_id]]
+        return np.unpackbits(row, count=len(self.concepts)).astype(bool)
+
+    def concepts_of(self, problem_id):
+        """ Names of the concepts required by the problem. """
+        return [concept for concept, flag in zip(self.concepts, self.flags(problem_id)) if flag]
+
+    def mask(self, all_of=(), any_of=(), none_of=()):
+        """
+        Boolean mask over the problems requiring all the concepts of all_of,
+        at least one of any_of (when given) and none of none_of.
+        """
+        mask = np.ones(len(self.ids), dtype=bool)
+        if all_of:
+            required = self.pack(all_of)
+            mask &= ((self.bits & required) == required).all(axis=1)
+        if any_of:
+            mask &= (self.bits & self.pack(any_of)).any(axis=1)
+        if none_of:
+            mask &= ~(self.bits & self.pack(none_of)).any(axis=1)
+        return mask
+
+    def query(self, all_of=(), any_of=(), none_of=()):
+        """ Ids of the problems matching the mask, e.g. query(all_of=["loop_nested", "file_read"]). """
+        return self.ids[self.mask(all_of, any_of, none_of)]
+
+    def to_frame(self):
+        """ Unpacked boolean concept matrix indexed by problem id. """
+        flags = np.unpackbits(self.bits, axis=1, count=len(self.concepts)).astype(bool)
+        return pd.DataFrame(flags, index=pd.Index(self.ids, name="id"), columns=self.concepts)
+
+    def counts(self):
+        """ Number of problems requiring each concept. """
+        return self.to_frame().sum()
@@ -1,43 +1,163 @@
 import os 
 import re 
+import json
+import numpy as np
 import pandas as pd
-from copy import deepcopy 
+from concurrent.futures import ProcessPoolExecutor
+from src.data.ConceptIndex import ConceptIndex, CONCEPTS
 from src.data.Dataset import Dataset
+from src.utils.cache import Cache, content_hash, file_hash
 from src.utils.TableConverter import TableConverter
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+# The problems table with their skeletons, written by scripts/preprocessing.py
+PROBLEMS_FILENAME = "falconcode_v1_table_problems_updated.csv"
+# Bump when html_to_md changes, so that cached prompts are converted again
+MARKDOWN_VERSION = 1
+# Bump when the snapshot layout changes
+SNAPSHOT_VERSION = 1
+# Everything _load_dataset depends on besides the source file
+PREPROCESSING = {
+    "deduplicate_on": "id",
+    "excluded_types": ["project"],
+    "unavailable_marker": "You have been provided with",
+    "sort_by": "id",
+    "markdown_version": MARKDOWN_VERSION,
+}
+
 class Falcon(Dataset):
+    """
+    The preprocessed FalconCode problems. The preprocessing result is saved as
+    a Parquet snapshot keyed on the source file and PREPROCESSING, later
+    instances only read the columns they are asked for. The returned
+    DataFrames share read-only column arrays: call .copy() before modifying
+    their values in place.
+    """
 
-    def __init__(self, dir_path) -> None:
+    def __init__(self, dir_path, cache_path=None, snapshot_dir=None,
+                 filename=PROBLEMS_FILENAME) -> None:
         self.dir_path = dir_path
-        self._dataset = self._load_dataset()
+        self.source_path = os.path.join(dir_path, filename)
+        # Converted prompts are cached next to the dataset by default
+        if cache_path is None:
+            cache_path = os.path.join(dir_path, "markdown_cache.sqlite")
+        self.cache_path = cache_path
+        self.snapshot_key = snapshot_key(self.source_path)
+        self.snapshot_path = os.path.join(snapshot_dir or dir_path,
+                                          f"falcon_v{SNAPSHOT_VERSION}_{self.snapshot_key[:16]}.parquet")
+        self._columns = {}
+        self._concept_index = None
+
+        if pq is not None and os.path.exists(self.snapshot_path):
+            self.columns = pq.read_schema(self.snapshot_path).names
+        else:
+            df = self._load_dataset()
+            if pq is not None:
+                write_snapshot(df, self.snapshot_path, self.snapshot_key)
+            self.columns = list(df.columns)
+            self._columns = read_only_columns(df)
 
     def _load_dataset(self):
-        df = pd.read_csv(os.path.join(self.config.path))
+        df = pd.read_csv(self.source_path)
         print("Original number of problems", len(df))
         # Remove duplicate ids for project (same content, multiple semesters)
-        df = df.drop_duplicates("id")
+        df = df.drop_duplicates(PREPROCESSING["deduplicate_on"])
         print("Number of problems after dropping duplicates", len(df))
         # Some columns have nan values
         df = df.fillna("")
         # Format the prompt for readability
-        df["prompt"] = df["prompt"].apply(html_to_md)
+        cache = Cache(self.cache_path)
+        df["prompt"] = convert_prompts(df["prompt"].tolist(), cache)
+        cache.close()
         # We do not have access to the external ressources (all the projects full description)
         # for assignments of type project, and they will be graded manually by instructors anyway 
-        df = df[df.type != "project"]
-        s = "You have been provided with"
+        df = df[~df.type.isin(PREPROCESSING["excluded_types"])]
+        s = PREPROCESSING["unavailable_marker"]
         mask = [s not in prompt for prompt in df["prompt"]]
         df = df[mask]
         print("Number of problems after droping unavailable ones", len(df))
-        df = df.sort_values(by="id")
+        df = df.sort_values(by=PREPROCESSING["sort_by"])
         df = df.reset_index(drop=True)
 
         return df
 
+    def select(self, columns=None):
+        """
+        Returns the given columns (all by default) as a DataFrame viewing the
+        read-only column arrays. Columns are read from the snapshot on first use.
+        """
+        columns = list(self.columns) if columns is None else list(columns)
+        unknown = [column for column in columns if column not in self.columns]
+        if unknown:
+            raise KeyError(f"Unknown columns {unknown}")
+        missing = [column for column in columns if column not in self._columns]
+        if missing:
+            table = pq.read_table(self.snapshot_path, columns=missing)
+            self._columns.update(read_only_columns(table.to_pandas()))
+        return pd.DataFrame({column: self._columns[column] for column in columns}, copy=False)
+
     @property
     def load_dataset(self):
-        return deepcopy(self._dataset)
-    
+        return self.select()
+
+    @property
+    def concept_index(self):
+        """ ConceptIndex of the problems, only the id and concept columns are read. """
+        if self._concept_index is None:
+            self._concept_index = ConceptIndex(self.select(["id", *CONCEPTS]))
+        return self._concept_index
+
+def snapshot_key(source_path):
+    """ Hash of the source file contents and of the preprocessing settings. """
+    return content_hash(SNAPSHOT_VERSION, file_hash(source_path),
+                        json.dumps(PREPROCESSING, sort_keys=True))
+
+def write_snapshot(df, path, key):
+    """ Writes df as Parquet, atomically so that concurrent readers never see partial files. """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b"falcon_snapshot_key": key.encode()})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+def read_only_columns(df):
+    columns = {}
+    for column in df.columns:
+        values = np.asarray(df[column].to_numpy())
+        values.flags.writeable = False
+        columns[column] = values
+    return columns
+
 # Create shorthand method for conversion
 def html_to_md(html, **options):
     mkdwn = TableConverter(**options).convert(html)
-    return re.sub(r'\n\s*\n', '\n', mkdwn).strip()
\ No newline at end of file
+    return re.sub(r'\n\s*\n', '\n', mkdwn).strip()
+
+def convert_prompts(prompts, cache=None, n_workers=None):
+    """
+    Applies html_to_md to every prompt. Conversions are memoized in the cache
+    by content hash, and the prompts missing from it are converted in parallel.
+    """
+    keys = [content_hash("html_to_md", MARKDOWN_VERSION, html) for html in prompts]
+    converted = cache.get_many(set(keys)) if cache is not None else {}
+    misses = {key: html for key, html in zip(keys, prompts) if key not in converted}
+
+    if misses:
+        # Starting a process pool is not worth it for a handful of prompts
+        if len(misses) < 32:
+            markdowns = list(map(html_to_md, misses.values()))
+        else:
+            with ProcessPoolExecutor(n_workers) as executor:
+                markdowns = list(executor.map(html_to_md, misses.values(), chunksize=8))
+        new = dict(zip(misses, markdowns))
+        if cache is not None:
+            cache.put_many(new)
+        converted.update(new)
+
+    return [converted[key] for key in keys]
@@ -0,0 +1,166 @@
+""" Incremental store of the student submission scores """
+
+import csv
+import hashlib
+import io
+import os
+import time
+import sqlite3
+
+import pandas as pd
+
+from src.analysis import SUBMISSION_COLUMNS, aggregate_submissions, student_outputs
+
+
+def read_hashes(path, size: int):
+    """ Hashes of the first size bytes of a file and of the whole file, and its size. """
+    sha, prefix = hashlib.sha256(), None
+    read = 0
+    with open(path, "rb") as f:
+        while read < size:
+            block = f.read(min(1 << 20, size - read))
+            if not block:
+                break
+            sha.update(block)
+            read += len(block)
+        prefix = sha.hexdigest() if read == size else None
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+            read += len(block)
+    return prefix, sha.hexdigest(), read
+
+
+class StudentAggregates():
+    """
+    Running sums and counts of the submission scores per (student, problem,
+    type), stored in SQLite. Batches of submissions are folded into the
+    running values once (batches are identified by id, files by content),
+    and the student output CSVs are written as views of the store. The
+    store remembers how much of each CSV file it read, so only the rows
+    appended to a file since are folded when it is added again.
+    """
+
+    def __init__(self, path, correct_score: float = 100) -> None:
+        self.path = path
+        self.correct_score = correct_score
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS aggregates ("
+                         "student_id TEXT, problem_id TEXT, type TEXT, "
+                         "score_sum REAL, n_success INTEGER, n INTEGER, "
+                         "PRIMARY KEY (student_id, problem_id, type))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS batches ("
+                         "batch_id TEXT PRIMARY KEY, n INTEGER, added REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, size INTEGER, hash TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        stored = self._db.execute("SELECT value FROM settings WHERE key = 'correct_score'").fetchone()
+        if stored is None:
+            self._db.execute("INSERT INTO settings VALUES ('correct_score', ?)", (repr(correct_score),))
+        elif float(stored[0]) != correct_score:
+            raise ValueError(f"{path} counts successes at score {stored[0]}, not {correct_score}")
+        self._db.commit()
+
+    def __contains__(self, batch_id):
+        return self._db.execute("SELECT 1 FROM batches WHERE batch_id = ?",
+                                (batch_id,)).fetchone() is not None
+
+    def add(self, submissions: pd.DataFrame, batch_id: str) -> bool:
+        """
+        Folds a batch of submissions (student_id, problem_id, type and score
+        columns) into the store. Returns False if the batch was already added.
+        """
+        return self._fold([submissions], batch_id)
+
+    def add_csv(self, path, batch_id=None, chunksize: int = 100_000) -> bool:
+        """
+        Folds the submissions of a CSV file, read in chunks of the needed
+        columns. Once a file was added, adding it again only folds the rows
+        appended to it since (a file changed otherwise raises a ValueError).
+        The batch id defaults to the hash of the file contents, so a new
+        file is only counted once whatever its name. Returns False if there
+        was nothing new to fold.
+        """
+        path = os.path.abspath(path)
+        known = self._db.execute("SELECT size, hash FROM files WHERE path = ?", (path,)).fetchone()
+        offset, known_hash = known if known is not None else (0, None)
+        prefix_hash, contents_hash, size = read_hashes(path, offset)
+        if known is not None and prefix_hash != known_hash:
+            raise ValueError(f"{path} changed since it was added, not only by appended rows")
+        if batch_id is None:
+            batch_id = contents_hash
+        source = (path, size, contents_hash)
+        if size == offset:
+            return False
+        if batch_id in self:
+            if batch_id == contents_hash:
+                # The same contents were added under another name
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", source)
+            return False
+
+        dtype = {"student_id": str, "problem_id": str, "type": str}
+        if not offset:
+            chunks = pd.read_csv(path, usecols=SUBMISSION_COLUMNS, chunksize=chunksize, dtype=dtype)
+            return self._fold(chunks, batch_id, source)
+        # The rows appended since, under the header of the file
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            columns = next(csv.reader(f))
+        with open(path, "rb") as f:
+            f.seek(offset)
+            chunks = pd.read_csv(io.TextIOWrapper(f, encoding="utf-8", newline=""), header=None, names=columns,
+                                 usecols=SUBMISSION_COLUMNS, chunksize=chunksize, dtype=dtype)
+            return self._fold(chunks, batch_id, source)
+
+    def _fold(self, batches, batch_id, source=None) -> bool:
+        if batch_id in self:
+            return False
+        n_submissions = 0
+        # A single transaction, an interrupted batch leaves the store untouched
+        with self._db:
+            for submissions in batches:
+                n_submissions += len(submissions)
+                aggregates = aggregate_submissions(submissions, self.correct_score)
+                rows = [(student_id, problem_id, problem_type, float(score_sum), int(n_success), int(n))
+                        for (student_id, problem_id, problem_type), score_sum, n_success, n
+                        in zip(aggregates.index, aggregates["score_sum"],
+                               aggregates["n_success"], aggregates["n"])]
+                self._db.executemany(
+                    "INSERT INTO aggregates VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (student_id, problem_id, type) DO UPDATE SET "
+                    "score_sum = score_sum + excluded.score_sum, "
+                    "n_success = n_success + excluded.n_success, n = n + excluded.n", rows)
+            self._db.execute("INSERT INTO batches VALUES (?, ?, ?)",
+                             (batch_id, n_submissions, time.time()))
+            if source is not None:
+                # The file and how much of it was read
+                self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", source)
+        return True
+
+    def to_frame(self) -> pd.DataFrame:
+        """ The running values, indexed by (student_id, problem_id, type) like aggregate_submissions. """
+        df = pd.read_sql_query("SELECT * FROM aggregates", self._db)
+        return df.set_index(["student_id", "problem_id", "type"])
+
+    def batches(self) -> pd.DataFrame:
+        return pd.read_sql_query("SELECT * FROM batches ORDER BY added", self._db)
+
+    def write_views(self, output_dir) -> list:
+        """ Writes the scatterplot, curveplot and barchart student outputs, returns their paths. """
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for filename, frame in student_outputs(self.to_frame()).items():
+            path = os.path.join(output_dir, filename)
+            frame.to_csv(path)
+            paths.append(path)
+        return paths
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
@@ -0,0 +1,52 @@
+""" Evaluating the functional correctness of the generated programs.
+The pass@k estimator follows
+https://github.com/openai/human-eval/blob/master/human_eval/evaluation.py
+"""
+
+from typing import Iterable, Union
+
+import numpy as np
+import pandas as pd
+
+
+def estimate_pass_at_k(num_samples: Union[int, np.ndarray],
+                       num_correct: np.ndarray, k: int) -> np.ndarray:
+    """
+    Estimates pass@k of each problem, i.e. 1 - C(n - c, k) / C(n, k) with n
+    samples of which c are correct, for all the problems at once.
+    """
+    num_correct = np.asarray(num_correct, dtype=np.int64)
+    num_samples = np.broadcast_to(np.asarray(num_samples, dtype=np.int64),
+                                  num_correct.shape)
+    if (num_samples < k).any():
+        raise ValueError(f"pass@{k} needs at least {k} samples per problem")
+
+    # C(n - c, k) / C(n, k) is the product of 1 - k / i for i in ]n - c, n],
+    # computed as a difference of cumulative sums of log(1 - k / i). The
+    # terms for i <= k are never part of a product and left to 0.
+    i = np.arange(1, num_samples.max(initial=k) + 1)
+    log_terms = np.zeros(len(i))
+    log_terms[i > k] = np.log1p(-k / i[i > k])
+    cumulative = np.concatenate([[0.0], np.cumsum(log_terms)])
+
+    num_wrong = num_samples - num_correct
+    lower = np.maximum(num_wrong, k)
+    pass_at_k = 1.0 - np.exp(cumulative[num_samples] - cumulative[lower])
+    return np.where(num_wrong < k, 1.0, pass_at_k)
+
+
+def compute_pass_at_k(results: pd.DataFrame, ks: Iterable[int] = (1, 10, 100),
+                      correct_score: float = 100) -> pd.DataFrame:
+    """
+    Groups the graded samples of results by problem id and returns, for each
+    problem, the number of samples, of correct ones (score of at least
+    correct_score) and pass@k for each k no larger than the samples.
+    """
+    correct = results["score"].to_numpy() >= correct_score
+    per_problem = (pd.DataFrame({"id": results["id"].to_numpy(), "correct": correct})
+                   .groupby("id")["correct"].agg(n="size", c="sum"))
+    n, c = per_problem["n"].to_numpy(), per_problem["c"].to_numpy()
+    for k in ks:
+        if (n >= k).all():
+            per_problem[f"pass@{k}"] = estimate_pass_at_k(n, c, k)
+    return per_problem
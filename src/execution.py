@@ -3,94 +3,706 @@ This code was adapted from
 https://github.com/openai/human-eval/blob/master/human_eval/execution.py
 """
 
-from typing import Optional, Callable, Dict
+from typing import Optional, Callable, Dict, Iterable, Iterator
 import ast
+import collections
 import contextlib
 import faulthandler
+import importlib
+import importlib.util
 import io
+import marshal
+import math
 import os
 import multiprocessing
+import multiprocessing.connection
 import platform
+import queue
+import resource
+import shutil
 import signal
+import sys
 import tempfile
+import threading
+import time
+import types
+import weakref
 
-import src.utils.autograder
+from src.utils.cache import Cache, content_hash
 from src.utils.files import write
 
 
+# A sandbox worker is replaced by a fresh process after grading this many
+# completions, which bounds the state generated programs can leak into it.
+MAX_JOBS_PER_WORKER = 50
+
+# Characters of output kept per job (the last ones) and read from each
+# student program when the sandbox has no output_limit
+MAX_OUTPUT = 2 ** 20
+SCORE_MARKER = "Unit Test Returned:"
+
+# Sandbox workers are started by a fork server rather than forked from the
+# parent, which can be running threads (e.g. the graders of src.pipeline)
+# whose locks a forked child would inherit held
+SANDBOX_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+if SANDBOX_CONTEXT.get_start_method() == "forkserver":
+    SANDBOX_CONTEXT.set_forkserver_preload(["__main__", __name__])
+
+# The worker scratch directories go to tmpfs when there is one
+SCRATCH_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+
+
 def check_correctness(problem: Dict, completion: str, timeout: float,
-                      completion_id: Optional[int] = None) -> Dict:
+                      completion_id: Optional[int] = None,
+                      cache: Optional[Cache] = None) -> Dict:
     """
     Evaluates the functional correctness of a completion by running the test
     suite provided in the problem. 
 
     :param completion_id: an optional completion ID so we can match
         the results later even if execution finishes asynchronously.
+    :param cache: an optional cache of grading results, see grading_key.
+    """
+    pool = get_default_pool()
+    key = grading_key(problem, timeout, pool.settings)
+    result = cache.get(key) if cache is not None else None
+    if result is None:
+        result = pool.run(problem, timeout)
+        if cache is not None and is_cacheable(result):
+            cache.put(key, cacheable_part(result))
+    if completion_id is not None:
+        result["completion_id"] = completion_id
+    return result
+
+
+def check_correctness_many(problems: Iterable[Dict], timeout: float,
+                           n_workers: Optional[int] = None,
+                           cache: Optional[Cache] = None,
+                           **options) -> Iterator[Dict]:
+    """
+    Evaluates many completions concurrently, one sandbox worker per core by
+    default, and yields the results as they finish. Each result is tagged
+    with the completion_id of its problem, or with the problem position in
+    problems when it has none. A problem can have its own "timeout",
+    e.g. set by src.scheduling.
+
+    :param cache: an optional cache of grading results, cached completions
+        are not sent to the sandbox.
+    :param options: options of the SandboxWorker, e.g. fork=True,
+        memory_limit=2**30 or keep_text=True, used instead of the default pool.
+    """
+    if cache is not None:
+        if n_workers is None and not options:
+            settings = get_default_pool().settings
+        else:
+            settings = grading_settings(**options)
+        yield from imap_cached(problems, timeout, cache, settings,
+                               lambda misses: check_correctness_many(
+                                   misses, timeout, n_workers, **options))
+        return
+    if n_workers is None and not options:
+        yield from get_default_pool().imap_unordered(problems, timeout)
+        return
+    pool = SandboxPool(n_workers or os.cpu_count() or 1, **options)
+    try:
+        yield from pool.imap_unordered(problems, timeout)
+    finally:
+        pool.close()
+
+
+def grading_key(problem: Dict, timeout: float, settings: Optional[Dict] = None) -> str:
+    """
+    Key of the grading result of a problem (with its data files) in a Cache,
+    under the given grading_settings.
+    """
+    parts = [problem["id"], problem["testcase"], problem["code"], timeout]
+    if settings and any(value is not None for value in settings.values()):
+        parts.append(sorted(settings.items()))
+    # Only problems with data files have them in their key, so the keys of
+    # the others are unchanged
+    if problem.get("files"):
+        parts.append(sorted(problem["files"].items()))
+    return content_hash(*parts)
+
+
+def grading_settings(keep_text: bool = False, inprocess: bool = False, **options) -> Dict:
+    """ The options of a SandboxWorker that change its results, and the environment ones. """
+    settings = get_limits(**options)
+    settings["text"] = True if keep_text else None
+    # The student programs can behave differently in the sandbox process
+    inprocess = inprocess or os.environ.get("AUTOGRADER_BACKEND") == "inprocess"
+    settings["backend"] = "inprocess" if inprocess else None
+    return settings
+
+
+def get_limits(memory_limit: Optional[int] = None, cpu_limit: Optional[float] = None,
+               output_limit: Optional[int] = None, **options) -> Dict:
+    """ The resource limits among the options of a SandboxWorker. """
+    return {"memory": memory_limit, "cpu": cpu_limit, "output": output_limit}
+
+
+def is_cacheable(result: Dict) -> bool:
+    """ Timeouts can be caused by the load of the machine, they are not cached. """
+    return result["exec_result"] != "timed out"
+
+
+def cacheable_part(result: Dict) -> Dict:
+    """ The result without its completion id and timings, which belong to one run. """
+    return {k: v for k, v in result.items() if k not in ("completion_id", "profile", "wall_seconds")}
+
+
+def imap_cached(problems: Iterable[Dict], timeout: float, cache: Cache,
+                settings: Optional[Dict], grade: Callable) -> Iterator[Dict]:
+    """ Yields the cached results of problems, and those of grade for the others. """
+    keys, hits = {}, collections.deque()
+
+    def misses():
+        for i, problem in enumerate(problems):
+            completion_id = problem.get("completion_id", i)
+            key = grading_key(problem, problem.get("timeout", timeout), settings)
+            result = cache.get(key)
+            if result is not None:
+                result["completion_id"] = completion_id
+                hits.append(result)
+            else:
+                keys[completion_id] = key
+                yield dict(problem, completion_id=completion_id)
+
+    for result in grade(misses()):
+        key = keys.pop(result["completion_id"])
+        if is_cacheable(result):
+            cache.put(key, cacheable_part(result))
+        while hits:
+            yield hits.popleft()
+        yield result
+    while hits:
+        yield hits.popleft()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_default_pool():
+    """ Returns the sandbox pool shared by all check_correctness calls (thread-safe). """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = SandboxPool(n_workers=os.cpu_count() or 1)
+        return _default_pool
+
+
+def set_default_pool(pool):
+    """ Replaces the pool used by check_correctness, e.g. by a fork-server one. """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None:
+            _default_pool.close()
+        _default_pool = pool
+
+
+class SandboxPool():
+    """
+    Pool of long-lived sandbox workers. Workers are started lazily, so
+    sequential grading only ever spawns a single process.
+    """
+
+    def __init__(self, n_workers: int = 1,
+                 max_jobs_per_worker: int = MAX_JOBS_PER_WORKER,
+                 **options) -> None:
+        self.n_workers = n_workers
+        self.settings = grading_settings(**options)
+        self._idle = queue.LifoQueue()
+        for _ in range(n_workers):
+            self._idle.put(SandboxWorker(max_jobs_per_worker, **options))
+
+    def run(self, problem: Dict, timeout: float) -> Dict:
+        """ Grades one problem on the first idle worker (thread-safe). """
+        worker = self._idle.get()
+        try:
+            return worker.run(problem, timeout)
+        finally:
+            self._idle.put(worker)
+
+    def imap_unordered(self, problems: Iterable[Dict],
+                       timeout: float) -> Iterator[Dict]:
+        """ Grades problems on all the idle workers, see check_correctness_many. """
+        workers = [self._idle.get()]
+        while len(workers) < self.n_workers:
+            try:
+                workers.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+        problems = enumerate(problems)
+        idle, busy = list(workers), {}
+        try:
+            while True:
+                # Keep every worker busy while there are problems left
+                while idle:
+                    try:
+                        i, problem = next(problems)
+                    except StopIteration:
+                        break
+                    worker = idle.pop()
+                    job_timeout = problem.get("timeout", timeout)
+                    worker.submit(problem, job_timeout)
+                    completion_id = problem.get("completion_id", i)
+                    deadline = time.monotonic() + job_timeout + worker.grace
+                    busy[worker.conn] = (worker, completion_id, deadline)
+                if not busy:
+                    return
+
+                next_deadline = min(deadline for _, _, deadline in busy.values())
+                wait = max(next_deadline - time.monotonic(), 0)
+                ready = multiprocessing.connection.wait(list(busy), timeout=wait)
+                now = time.monotonic()
+                for conn, (worker, completion_id, deadline) in list(busy.items()):
+                    if conn not in ready and deadline > now:
+                        continue
+                    del busy[conn]
+                    result = worker.collect(None if conn in ready else 0)
+                    result["completion_id"] = completion_id
+                    idle.append(worker)
+                    yield result
+        finally:
+            # Abandoned jobs would otherwise be collected by the next caller
+            for worker, _, _ in busy.values():
+                worker.stop()
+            for worker in workers:
+                self._idle.put(worker)
+
+    def close(self):
+        """ Stops the workers, which start again if the pool is used afterwards. """
+        workers = [self._idle.get() for _ in range(self.n_workers)]
+        for worker in workers:
+            worker.stop()
+            self._idle.put(worker)
+
+
+class SandboxWorker():
     """
+    Parent side handle of a sandbox process. The process is guarded once
+    and then receives the jobs to grade over a pipe. It is restarted after
+    max_jobs jobs, or when it timed out or crashed.
+
+    With fork=True the process is instead a fork server: it never runs
+    generated code itself but forks a guarded child per job from a template
+    in which the autograder is already imported.
+
+    With inprocess=True, autograder.run_script runs the student programs in
+    the sandbox process instead of starting an interpreter per input list.
+
+    memory_limit (bytes of address space), cpu_limit (CPU seconds per job)
+    and output_limit (characters) bound every job, in the sandbox process
+    and in the student programs run by autograder.run_script.
+
+    The results only hold the output of the testcase with keep_text=True,
+    otherwise their text is empty. With profile=True they also hold the
+    timings of the grading phases, see unsafe_execute.
+    """
+
+    def __init__(self, max_jobs: int = MAX_JOBS_PER_WORKER,
+                 fork: bool = False, inprocess: bool = False,
+                 memory_limit: Optional[int] = None,
+                 cpu_limit: Optional[float] = None,
+                 output_limit: Optional[int] = None,
+                 keep_text: bool = False, profile: bool = False) -> None:
+        self.max_jobs = max_jobs
+        self.fork = fork
+        self.inprocess = inprocess
+        self.limits = get_limits(memory_limit, cpu_limit, output_limit)
+        self.keep_text = keep_text
+        self.profile = profile
+        # The fork server kills overdue children itself, one second after
+        # their timeout, so the parent waits a bit longer before giving up
+        self.grace = 2 if fork else 1
+        self.process = None
+        self.conn = None
+        self.workspace = None
+        self._remove_workspace = None
+        self.n_jobs = 0
+        self.started = 0.0
+        self.submitted = 0.0
+
+    def start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        # Created and removed here, the worker can be killed at any time. It
+        # is also removed when the handle is collected or the parent exits
+        self.workspace = tempfile.mkdtemp(prefix="sandbox_", dir=SCRATCH_ROOT)
+        self._remove_workspace = weakref.finalize(self, shutil.rmtree, self.workspace,
+                                                  ignore_errors=True)
+        target = fork_serve if self.fork else serve
+        self.process = SANDBOX_CONTEXT.Process(target=target,
+                                              args=(child_conn, self.inprocess,
+                                                    self.limits, self.workspace),
+                                              daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.n_jobs = 0
+
+    def stop(self):
+        if self.process is not None:
+            self.conn.close()
+            self.process.kill()
+            self.process.join()
+            self._remove_workspace()
+        self.process, self.conn, self.workspace = None, None, None
+
+    def submit(self, problem: Dict, timeout: float):
+        self.submitted = time.monotonic()
+        self.started = 0.0
+        if (self.process is None or not self.process.is_alive()
+                or self.n_jobs >= self.max_jobs):
+            self.stop()
+            self.start()
+            self.started = time.monotonic() - self.submitted
+        # Only send what the sandbox needs, problems rows also carry the prompt,
+        # and the testcase goes as the marshalled code object compiled once
+        job = {k: problem[k] for k in ("id", "code")}
+        job["files"] = problem.get("files") or {}
+        job["testcase"] = get_compiled_testcase(problem["testcase"])
+        job["keep_text"] = self.keep_text
+        job["profile"] = self.profile
+        self.conn.send((job, timeout))
+        self.n_jobs += 1
+
+    def collect(self, wait: Optional[float] = None) -> Dict:
+        """ Waits at most wait seconds for the result of the submitted job. """
+        result = None
+        try:
+            if wait is None or self.conn.poll(wait):
+                result = self.conn.recv()
+        except (EOFError, OSError):
+            pass
+        if result is None:
+            # The program could not be interrupted or brought the worker down
+            self.stop()
+            result = {"exec_result": "timed out", "score": 0, "text": ""}
+        # Wall time of the job itself, without the start of a new worker
+        result["wall_seconds"] = time.monotonic() - self.submitted - self.started
+        if self.profile:
+            profile = result.setdefault("profile", {})
+            profile["worker_start"] = self.started
+            profile["round_trip"] = time.monotonic() - self.submitted
+        return result
+
+    def run(self, problem: Dict, timeout: float) -> Dict:
+        self.submit(problem, timeout)
+        return self.collect(timeout + self.grace)
+
+
+def serve(conn, inprocess: bool = False, limits: Optional[Dict] = None,
+          workspace: Optional[str] = None):
+    """ Main loop of a sandbox worker process. """
+
+    limits = limits or get_limits()
+    configure_autograder(inprocess, limits)
+    # Every job imports its own copy of the autograder, from a code object
+    workspace = Workspace(workspace or tempfile.mkdtemp(), fresh_autograder=True)
 
-    def unsafe_execute():
+    # These system calls are needed to reset the workspace.
+    saved = save_tempdir_functions()
 
-        with create_tempdir():
+    # Disable functionalities that can make destructive changes to the test.
+    reliability_guard(limits["memory"])
 
-            # These system calls are needed when cleaning up tempdir.
-            import os
-            import sys 
-            import shutil
+    while True:
+        try:
+            problem, timeout = conn.recv()
+        except EOFError:
+            # The parent is gone, it may not have removed the workspace
+            with unguarded(saved):
+                workspace.remove()
+            break
+        with cpu_time_limit(limits["cpu"]):
+            result = unsafe_execute(problem, timeout, workspace, limits["output"] or MAX_OUTPUT)
+        conn.send(result)
+        with unguarded(saved):
+            workspace.reset()
 
-            rmtree = shutil.rmtree
-            rmdir = os.rmdir
-            chdir = os.chdir
-            unlink = os.unlink
 
-            # Disable functionalities that can make destructive changes to the test.
-            reliability_guard()
+def fork_serve(conn, inprocess: bool = False, limits: Optional[Dict] = None,
+               workspace: Optional[str] = None):
+    """ Main loop of a fork-server sandbox worker. """
 
-            # adding the temp dir to the path such that autograder.py can be seen 
-            sys.path.append("./")
+    limits = limits or get_limits()
+    configure_autograder(inprocess, limits)
+    # The children share the workspace, reset by the server after each job
+    workspace = Workspace(workspace or tempfile.mkdtemp())
 
-            write(problem["id"] + ".py", problem["code"])
-            write("autograder.py", get_autograder_code())
-            exec_string = create_execution_string(problem["testcase"])
-                        
+    # Testcases import the autograder under that name, preloading it saves
+    # every job the import of the autograder and of its dependencies. It
+    # reads the __main__ module, only set up in the worker itself
+    import src.utils.autograder
+    sys.modules["autograder"] = src.utils.autograder
+
+    while True:
+        try:
+            problem, timeout = conn.recv()
+        except EOFError:
+            workspace.remove()
+            break
+
+        # Unmarshalled here, the forked children inherit the code objects
+        try:
+            load_testcase(problem["testcase"])
+        except InvalidTestcase:
+            pass
+
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        pid = os.fork()
+        if pid == 0:
             try:
-                exec_globals = {}
-                stream = io.StringIO()
-                with contextlib.redirect_stdout(stream):
-                    with contextlib.redirect_stderr(stream):
-                        with redirect_stdin(stream):
-                            exec(exec_string, exec_globals)
-                unit_test_result = stream.getvalue()
-                score = get_unit_test_score(unit_test_result)
-                result.append({"exec_result": "completed", "score": score, "text": unit_test_result})
-                assert isinstance(score, float)
-
-            except TimeoutException:
-                result.append({"exec_result": "timed out", "score": 0, "text": unit_test_result})
-            except BaseException as e:
-                result.append({"exec_result": f"failed: {e}", "score": 0, "text": ""})
-                # print(result[-1])
-            
-            # Needed for cleaning up.
-            shutil.rmtree = rmtree
-            os.rmdir = rmdir
-            os.chdir = chdir
-            os.unlink = unlink
-            # remove the temp dir from the path 
-            sys.path.pop()
-
-    manager = multiprocessing.Manager()
-    result = manager.list()
-
-    p = multiprocessing.Process(target=unsafe_execute)
-    p.start()
-    p.join(timeout=timeout + 1)
-    if p.is_alive():
-        p.kill()
-
-    if not result:
-        result.append({"exec_result": "timed out", "score": 0, "text": ""})
-
-    return result[0]
+                conn.close()
+                reader.close()
+                reliability_guard(limits["memory"])
+                # The child starts with no CPU time used, the hard limit
+                # kills it if it keeps running past the soft one
+                with cpu_time_limit(limits["cpu"], hard=True):
+                    result = unsafe_execute(problem, timeout, workspace, limits["output"] or MAX_OUTPUT)
+                writer.send(result)
+            finally:
+                os._exit(0)
+
+        writer.close()
+        result = {"exec_result": "timed out", "score": 0, "text": ""}
+        try:
+            if reader.poll(timeout + 1):
+                result = reader.recv()
+        except (EOFError, OSError):
+            pass
+        reader.close()
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        conn.send(result)
+        workspace.reset()
+
+
+def configure_autograder(inprocess: bool, limits: Dict):
+    """ Passes the backend and the limits of the student programs to autograder.run_script. """
+    if inprocess:
+        os.environ["AUTOGRADER_BACKEND"] = "inprocess"
+    limits = dict(limits, output=limits["output"] or MAX_OUTPUT)
+    for name, value in limits.items():
+        if value is not None:
+            os.environ[f"AUTOGRADER_{name.upper()}_LIMIT"] = str(value)
+
+
+class Workspace():
+    """
+    Scratch directory reused by the jobs of a sandbox worker, which works in
+    it. autograder.py is written once, and reset() only removes the files
+    created by the last job.
+
+    With fresh_autograder=True, load_autograder gives every job a new
+    autograder module, executed from a code object compiled once.
+    """
+
+    def __init__(self, dirname: str, fresh_autograder: bool = False) -> None:
+        self.dirname = dirname
+        self.autograder_path = os.path.join(dirname, "autograder.py")
+        self.autograder_source = get_autograder_code()
+        self.autograder_code = None
+        if fresh_autograder:
+            self.autograder_code = compile(self.autograder_source, self.autograder_path, "exec")
+        self.write_autograder()
+        os.chdir(dirname)
+        # adding the workspace to the path such that autograder.py can be seen
+        sys.path.append(dirname)
+        # Stale bytecode of a previous job's program could otherwise be used
+        sys.dont_write_bytecode = True
+        os.environ["PYTHONDONTWRITEBYTECODE"] = "1"
+
+    def write_autograder(self):
+        write(self.autograder_path, self.autograder_source)
+        self.autograder_stat = self.stat(self.autograder_path)
+
+    @staticmethod
+    def stat(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def prepare(self, problem: Dict):
+        """ Writes the program of the problem and its data files. """
+        write(os.path.join(self.dirname, problem["id"] + ".py"), problem["code"])
+        for name, content in problem.get("files", {}).items():
+            write(os.path.join(self.dirname, name), content)
+        # Directory listings cached by the import system may be outdated
+        importlib.invalidate_caches()
+
+    def load_autograder(self):
+        """ Imports a new autograder module, see fresh_autograder. """
+        if self.autograder_code is None:
+            return
+        module = types.ModuleType("autograder")
+        module.__file__ = self.autograder_path
+        sys.modules["autograder"] = module
+        exec(self.autograder_code, module.__dict__)
+
+    def reset(self):
+        """ Removes everything but autograder.py, restored if it was modified. """
+        try:
+            entries = os.scandir(self.dirname)
+        except FileNotFoundError:
+            # Removed with the worker handle, the worker reads EOF next
+            return
+        with entries:
+            for entry in entries:
+                if entry.name == "autograder.py":
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+        try:
+            changed = self.stat(self.autograder_path) != self.autograder_stat
+        except OSError:
+            changed = True
+        if changed:
+            self.write_autograder()
+
+    def remove(self):
+        """ Removes the whole directory, when the worker stops. """
+        os.chdir(os.path.dirname(self.dirname) or "/")
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+
+def unsafe_execute(problem: Dict, timeout: float, workspace: Workspace,
+                   output_limit: Optional[int] = None) -> Dict:
+    """
+    Runs the testcase of the problem against its code in the workspace. This
+    should only be called in a sandbox worker, the workspace is reset by the
+    caller after the job. Only the last
+    output_limit characters of the testcase output are kept, and they go to
+    the result when problem["keep_text"] is set.
+
+    When problem["profile"] is set, result["profile"] holds the seconds
+    spent in each of PHASES and in the run_script calls (starting the
+    programs and running them), and the number of calls and subprocesses.
+
+    The result also holds the CPU seconds used by the job, the largest peak
+    resident memory (bytes) of the programs it ran in subprocesses (None if
+    none ran) and the one of the worker (worker_peak_rss), which in a
+    persistent worker is the one since the worker started.
+    """
+    usage = resource_usage()
+    times = [time.monotonic()]
+    stream = OutputCapture(output_limit or MAX_OUTPUT)
+    try:
+        workspace.prepare(problem)
+        times.append(time.monotonic())
+        # The autograder dependencies stay imported for the next jobs
+        with contextlib.redirect_stdout(stream):
+            workspace.load_autograder()
+        times.append(time.monotonic())
+        # modules imported by the testcase must not be reused by the next
+        # job, which comes with its own files
+        modules = set(sys.modules)
+    except BaseException as e:
+        result = {"exec_result": f"failed: {e}", "score": 0, "text": ""}
+        result.update(usage_since(usage))
+        return result
+
+    autograder = sys.modules["autograder"]
+    autograder.script_timings = [] if problem.get("profile") else None
+    autograder.script_peak_rss = 0
+    try:
+        testcase = load_testcase(problem["testcase"])
+        times.append(time.monotonic())
+        exec_globals = {}
+        with contextlib.redirect_stdout(stream):
+            with contextlib.redirect_stderr(stream):
+                with redirect_stdin(stream):
+                    with time_limit(timeout):
+                        exec(testcase, exec_globals)
+        score = stream.score()
+        result = {"exec_result": "completed", "score": score}
+        assert isinstance(score, float)
+
+    except TimeoutException:
+        result = {"exec_result": "timed out", "score": 0}
+    except BaseException as e:
+        result = {"exec_result": f"failed: {e}", "score": 0}
+    times.append(time.monotonic())
+    result["text"] = stream.getvalue() if problem.get("keep_text") else ""
+    if autograder.script_timings is not None:
+        result["profile"] = job_profile(times, autograder.script_timings)
+        autograder.script_timings = None
+    result["peak_rss"] = autograder.script_peak_rss or None
+    autograder.script_peak_rss = None
+
+    for name in set(sys.modules) - modules:
+        del sys.modules[name]
+
+    result.update(usage_since(usage))
+    return result
+
+
+# Phases of a job timed by unsafe_execute, the testcase one includes its
+# run_script calls
+PHASES = ["prepare", "autograder", "load_testcase", "testcase"]
+
+def job_profile(times, script_timings) -> Dict:
+    """ Seconds per phase from the times between them, and the run_script totals. """
+    profile = {phase: end - start for phase, start, end in zip(PHASES, times, times[1:])}
+    profile["run_script_calls"] = len(script_timings)
+    profile["subprocesses"] = sum(1 for _, _, in_subprocess in script_timings if in_subprocess)
+    profile["script_start"] = sum(start for start, _, _ in script_timings)
+    profile["script_run"] = sum(run for _, run, _ in script_timings)
+    return profile
+
+
+def resource_usage():
+    """ Resource usage of the process and of its terminated children. """
+    return (resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def usage_since(usage) -> Dict:
+    """
+    CPU seconds used since usage was measured, and peak resident memory of
+    the worker and its children so far (not of the job).
+    """
+    cpu_seconds, peak_rss = 0.0, 0
+    for before, after in zip(usage, resource_usage()):
+        cpu_seconds += (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+        peak_rss = max(peak_rss, after.ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if platform.uname().system != 'Darwin':
+        peak_rss *= 1024
+    return {"cpu_seconds": round(cpu_seconds, 3), "worker_peak_rss": peak_rss}
+
+
+@contextlib.contextmanager
+def cpu_time_limit(seconds: Optional[float], hard: bool = False):
+    """
+    Raises CpuTimeExceeded once the process used seconds more CPU time,
+    through the soft RLIMIT_CPU. With hard=True the hard limit is also set,
+    one second later, which cannot be raised again.
+    """
+    if seconds is None:
+        yield
+        return
+    def signal_handler(signum, frame):
+        raise CpuTimeExceeded("CPU time limit exceeded")
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = math.ceil(usage.ru_utime + usage.ru_stime + seconds)
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard:
+        hard_limit = soft + 1
+    elif hard_limit != resource.RLIM_INFINITY:
+        soft = min(soft, hard_limit)
+    previous_handler = signal.signal(signal.SIGXCPU, signal_handler)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard_limit))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard_limit, hard_limit))
+        signal.signal(signal.SIGXCPU, previous_handler)
 
 
 @contextlib.contextmanager
@@ -121,8 +733,86 @@ def create_tempdir():
             yield dirname
 
 
-class TimeoutException(Exception):
-    pass
+class TimeoutException(BaseException):
+    """ Not an Exception, so that generated programs and run_script do not catch it """
+
+
+class CpuTimeExceeded(BaseException):
+    """ Not an Exception, so that generated programs do not catch it """
+
+
+class OutputCapture(io.TextIOBase):
+    """
+    Output stream of a job keeping only the last limit characters written,
+    in a ring of chunks. The score printed after SCORE_MARKER is looked for
+    as the output streams in, the last one printed counts.
+    """
+
+    def __init__(self, limit: int = MAX_OUTPUT) -> None:
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+        self.written = 0
+        # End of the current line, where the marker may be
+        self.line = ""
+        self.score_text = None
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def read(self, *args):
+        return ""
+
+    def readline(self, *args):
+        return ""
+
+    def write(self, s):
+        if not isinstance(s, str):
+            raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+        n = len(s)
+        self.find_score(s)
+        self.written += n
+        if n >= self.limit:
+            self.chunks.clear()
+            s = s[-self.limit:]
+            self.size = 0
+        self.chunks.append(s)
+        self.size += len(s)
+        while self.size > self.limit:
+            excess = self.size - self.limit
+            first = self.chunks.popleft()
+            if len(first) > excess:
+                self.chunks.appendleft(first[excess:])
+            self.size -= min(len(first), excess)
+        return n
+
+    def find_score(self, s):
+        if "\n" not in s:
+            self.line = (self.line + s)[-256:]
+            return
+        *lines, self.line = (self.line + s).split("\n")
+        self.line = self.line[-256:]
+        for line in reversed(lines):
+            if SCORE_MARKER in line:
+                self.score_text = line.rsplit(SCORE_MARKER, 1)[1]
+                return
+
+    def score(self) -> float:
+        """ The score printed after the last marker, 0.0 if there is none. """
+        text = self.score_text
+        if SCORE_MARKER in self.line:
+            text = self.line.rsplit(SCORE_MARKER, 1)[1]
+        return float(text.strip()) if text is not None else 0.0
+
+    def getvalue(self) -> str:
+        """ The output kept, after a marker telling how much was truncated. """
+        text = "".join(self.chunks)
+        if self.written > self.size:
+            return f"[... {self.written - self.size} characters truncated ...]\n{text}"
+        return text
 
 
 class WriteOnlyStringIO(io.StringIO):
@@ -146,6 +836,27 @@ class redirect_stdin(contextlib._RedirectStream):  # type: ignore
     _stream = 'stdin'
 
 
+def save_tempdir_functions():
+    """ Saves the functions disabled by reliability_guard that Workspace.reset needs. """
+    saved = [(os, name, getattr(os, name))
+             for name in ("chdir", "getcwd", "rmdir", "unlink")]
+    saved.append((shutil, "rmtree", shutil.rmtree))
+    return saved
+
+
+@contextlib.contextmanager
+def unguarded(saved):
+    """ Temporarily restores functions disabled by reliability_guard. """
+    current = [(module, name, getattr(module, name)) for module, name, _ in saved]
+    for module, name, function in saved:
+        setattr(module, name, function)
+    try:
+        yield
+    finally:
+        for module, name, function in current:
+            setattr(module, name, function)
+
+
 @contextlib.contextmanager
 def chdir(root):
     if root == ".":
@@ -161,6 +872,18 @@ def chdir(root):
         os.chdir(cwd)
 
 
+# Functions set to None by reliability_guard, by module
+DISABLED_FUNCTIONS = {
+    "builtins": ["exit", "quit", "help"],
+    "os": ["kill", "system", "putenv", "remove", "removedirs", "rmdir", "fchdir",
+           "setuid", "fork", "forkpty", "killpg", "rename", "renames", "truncate",
+           "replace", "unlink", "fchmod", "fchown", "chmod", "chown", "chroot",
+           "lchflags", "lchmod", "lchown", "getcwd", "chdir"],
+    "shutil": ["rmtree", "move", "chown"],
+}
+# Modules reliability_guard makes impossible to import
+DISABLED_MODULES = ["ipdb", "joblib", "resource", "psutil", "tkinter"]
+
 def reliability_guard(maximum_memory_bytes: Optional[int] = None):
     """
     This disables various destructive functions and prevents the generated code
@@ -175,7 +898,6 @@ def reliability_guard(maximum_memory_bytes: Optional[int] = None):
     """
 
     if maximum_memory_bytes is not None:
-        import resource
         resource.setrlimit(resource.RLIMIT_AS, (maximum_memory_bytes, maximum_memory_bytes))
         resource.setrlimit(resource.RLIMIT_DATA, (maximum_memory_bytes, maximum_memory_bytes))
         if not platform.uname().system == 'Darwin':
@@ -183,80 +905,124 @@ def reliability_guard(maximum_memory_bytes: Optional[int] = None):
 
     faulthandler.disable()
 
-    import builtins
-    builtins.exit = None
-    builtins.quit = None
-
-    import os
     os.environ['OMP_NUM_THREADS'] = '1'
 
-    os.kill = None
-    os.system = None
-    os.putenv = None
-    os.remove = None
-    os.removedirs = None
-    os.rmdir = None
-    os.fchdir = None
-    os.setuid = None
-    os.fork = None
-    os.forkpty = None
-    os.killpg = None
-    os.rename = None
-    os.renames = None
-    os.truncate = None
-    os.replace = None
-    os.unlink = None
-    os.fchmod = None
-    os.fchown = None
-    os.chmod = None
-    os.chown = None
-    os.chroot = None
-    os.fchdir = None
-    os.lchflags = None
-    os.lchmod = None
-    os.lchown = None
-    os.getcwd = None
-    os.chdir = None
-
-    import shutil
-    shutil.rmtree = None
-    shutil.move = None
-    shutil.chown = None
-
-    import subprocess # we need subprocess.Popen by the autograder module 
-    #subprocess.Popen = None  # type: ignore
-
-    __builtins__['help'] = None
-
-    import sys
-    sys.modules['ipdb'] = None
-    sys.modules['joblib'] = None
-    sys.modules['resource'] = None
-    sys.modules['psutil'] = None
-    sys.modules['tkinter'] = None
-
-
-
-def create_execution_string(testcase):
-    testcase = testcase.replace("from cs110 import autograder", "import autograder")
-    testcase = testcase.replace("if __name__ == '__main__':", "")
-    testcase = testcase.replace("result = test_passed()", "")
-    testcase = testcase.replace('print("Unit Test Returned:", result)', "")
-    testcase = testcase.strip()
-    testcase = testcase + "\nresult = test_passed()\n"
-    testcase = testcase + 'print("Unit Test Returned:", result)'
-    
-    return testcase
+    # subprocess.Popen is kept, the autograder module needs it
+    for name, functions in DISABLED_FUNCTIONS.items():
+        module = importlib.import_module(name)
+        for function in functions:
+            setattr(module, function, None)
+
+    for name in DISABLED_MODULES:
+        sys.modules[name] = None
+
+
+
+class InvalidTestcase(Exception):
+    pass
+
+
+class CompiledTestcase():
+    """ Marshalled code of a rewritten testcase, or the reason it is invalid """
+
+    def __init__(self, key: str, code: Optional[bytes] = None,
+                 error: Optional[str] = None) -> None:
+        self.key = key
+        self.code = code
+        self.error = error
+
+
+def is_main_guard(node) -> bool:
+    """ Whether node is an `if __name__ == '__main__':` statement. """
+    return (isinstance(node, ast.If) and isinstance(node.test, ast.Compare)
+            and isinstance(node.test.left, ast.Name) and node.test.left.id == "__name__"
+            and len(node.test.comparators) == 1
+            and isinstance(node.test.comparators[0], ast.Constant)
+            and node.test.comparators[0].value == "__main__")
+
+
+class AutograderImport(ast.NodeTransformer):
+    """ Imports the autograder copied next to the program instead of cs110.autograder. """
+
+    def visit_ImportFrom(self, node):
+        if node.module != "cs110" or node.level != 0:
+            return node
+        nodes = [ast.Import(names=[alias]) for alias in node.names if alias.name == "autograder"]
+        others = [alias for alias in node.names if alias.name != "autograder"]
+        if others:
+            nodes.append(ast.ImportFrom(module=node.module, names=others, level=0))
+        return [ast.copy_location(new, node) for new in nodes]
+
+
+def rewrite_testcase(testcase: str) -> ast.Module:
+    """
+    Turns a testcase into a module that imports the local autograder, drops
+    the `if __name__ == '__main__':` block and ends by printing the score of
+    test_passed() after the "Unit Test Returned:" marker.
+    """
+    tree = AutograderImport().visit(ast.parse(testcase))
+    tree.body = [node for node in tree.body if not is_main_guard(node)]
+    if not any(isinstance(node, ast.FunctionDef) and node.name == "test_passed"
+               for node in tree.body):
+        raise InvalidTestcase("the testcase does not define test_passed")
+    tree.body += ast.parse('result = test_passed()\n'
+                           'print("Unit Test Returned:", result)').body
+    return ast.fix_missing_locations(tree)
+
+
+_compiled_testcases = {}
+
+def get_compiled_testcase(testcase: str) -> CompiledTestcase:
+    """ Rewrites and compiles the testcase, once per distinct testcase. """
+    key = content_hash(testcase)
+    compiled = _compiled_testcases.get(key)
+    if compiled is None:
+        try:
+            code = compile(rewrite_testcase(testcase), "<string>", "exec")
+            compiled = CompiledTestcase(key, code=marshal.dumps(code))
+        except (SyntaxError, ValueError, InvalidTestcase) as e:
+            compiled = CompiledTestcase(key, error=str(e))
+        _compiled_testcases[key] = compiled
+    return compiled
+
+
+def precompile_testcases(testcases: Iterable[str]) -> Dict[str, str]:
+    """
+    Compiles the distinct testcases ahead of grading, e.g. when the dataset
+    is loaded, and returns the errors of the invalid ones by testcase hash.
+    """
+    errors = {}
+    for testcase in set(testcases):
+        compiled = get_compiled_testcase(testcase)
+        if compiled.error is not None:
+            errors[compiled.key] = compiled.error
+    return errors
+
+
+_loaded_testcases = {}
+
+def load_testcase(testcase):
+    """ Code object of a testcase given as source or CompiledTestcase, memoized per worker. """
+    if isinstance(testcase, str):
+        testcase = get_compiled_testcase(testcase)
+    if testcase.error is not None:
+        raise InvalidTestcase(testcase.error)
+    code = _loaded_testcases.get(testcase.key)
+    if code is None:
+        if len(_loaded_testcases) >= 1024:
+            _loaded_testcases.clear()
+        code = _loaded_testcases[testcase.key] = marshal.loads(testcase.code)
+    return code
 
 def get_autograder_code():
     """ Super dirty but temporary """
-    with open(src.utils.autograder.__file__, "r") as fp:
+    # Not imported, see fork_serve
+    with open(importlib.util.find_spec("src.utils.autograder").origin, "r") as fp:
         file_content = fp.read()
     return file_content
 
 def get_unit_test_score(testcase_output):
-    lines = testcase_output.splitlines()
-    utr = [l for l in lines if l.startswith("Unit Test Returned:")]
-    if utr:
-        return float(utr[0].replace("Unit Test Returned:", "").strip())
-    return 0.0
\ No newline at end of file
+    """ Score of a whole testcase output, like OutputCapture.score. """
+    capture = OutputCapture(len(testcase_output) + 1)
+    capture.write(testcase_output)
+    return capture.score()
\ No newline at end of file
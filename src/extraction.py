@@ -0,0 +1,141 @@
+""" Extraction of the program from the answer of a model.
+
+Answers come as a bare program, as markdown code blocks surrounded by prose
+(```python, ```py, several blocks, sometimes an unterminated one when the
+answer was cut), or in the `=== file.py ===` format of the prompts in config.
+The answer is read line by line in a single pass, and can be fed as it
+streams in: every block is parsed as soon as it is closed.
+"""
+
+import re
+import textwrap
+from typing import List, Optional
+
+from src.utils.code import get_ast
+
+FENCE = re.compile(r"^\s*(`{3,}|~{3,})\s*([\w+#.-]*)")
+FILE_HEADER = re.compile(r"^\s*===\s*([^=\s][^=]*?)\s*===\s*(.*)$")
+FILE_END = re.compile(r"^\s*===\s*$")
+INLINE_FILE_END = re.compile(r"\s*===\s*$")
+# Languages of the fenced blocks that can hold the program, "" for none
+PYTHON_LANGUAGES = {"", "python", "python3", "py", "py3"}
+
+
+class CodeBlock():
+    """ Lines of a code block, and whether they parse once the block is closed. """
+
+    def __init__(self, language: str = "", filename: Optional[str] = None) -> None:
+        self.language = language
+        self.filename = filename
+        self.lines = []
+        self.code = ""
+        self.parses = None
+        self.size = 0
+
+    def close(self):
+        lines = self.lines
+        # The file format inside a fence
+        if lines and FILE_HEADER.match(lines[0]):
+            header = FILE_HEADER.match(lines[0])
+            self.filename = self.filename or header.group(1)
+            lines = ([header.group(2)] if header.group(2) else []) + lines[1:]
+        end = len(lines)
+        while end and (not lines[end - 1].strip() or FILE_END.match(lines[end - 1])):
+            end -= 1
+        lines = lines[:end]
+        self.code = textwrap.dedent("\n".join(lines)) + "\n" if lines else ""
+        self.parses = bool(self.code.strip()) and get_ast(self.code) is not None
+        self.size = sum(1 for line in lines if line.strip())
+
+
+class CodeExtractor():
+    """
+    Incremental extractor of the program of an answer: feed the answer in
+    chunks of any size, then finish returns the program. Among the blocks
+    of the answer, the ones named filename are preferred, then the ones
+    that parse, then the longest. Without blocks, the answer is the program.
+    """
+
+    def __init__(self, filename: Optional[str] = None) -> None:
+        self.filename = filename
+        self.blocks: List[CodeBlock] = []
+        self.chunks = []
+        self._partial = []
+        self._block = None
+        self._fence = None
+
+    def feed(self, chunk: str):
+        """ Adds the next part of the answer, complete lines are processed right away. """
+        self.chunks.append(chunk)
+        *complete, last = chunk.split("\n")
+        if complete:
+            self._partial.append(complete[0])
+            complete[0] = "".join(self._partial)
+            self._partial = []
+            for line in complete:
+                self.add_line(line.rstrip("\r"))
+        if last:
+            self._partial.append(last)
+
+    def add_line(self, line: str):
+        fence = FENCE.match(line)
+        if self._fence is not None:
+            # Only a bare fence as long as the opening one closes the block
+            if fence and not fence.group(2) and fence.group(1).startswith(self._fence) \
+                    and not line.strip().strip(self._fence[0]):
+                self.close_block()
+            else:
+                self._block.lines.append(line)
+            return
+
+        if fence:
+            self.close_block()
+            self._fence = fence.group(1)
+            self.open_block(CodeBlock(fence.group(2).lower()))
+            return
+        header = FILE_HEADER.match(line)
+        if header:
+            self.close_block()
+            self.open_block(CodeBlock(filename=header.group(1)))
+            # The whole file on the header line, e.g. === a.py === print(1) ===
+            code, ends = INLINE_FILE_END.subn("", header.group(2))
+            if code:
+                self._block.lines.append(code)
+            if ends:
+                self.close_block()
+        elif self._block is not None:
+            if FILE_END.match(line):
+                self.close_block()
+            else:
+                self._block.lines.append(line)
+
+    def open_block(self, block: CodeBlock):
+        self._block = block
+        self.blocks.append(block)
+
+    def close_block(self):
+        if self._block is not None:
+            self._block.close()
+        self._block = None
+        self._fence = None
+
+    def finish(self) -> str:
+        """ The program of the whole answer. """
+        if self._partial:
+            self.add_line("".join(self._partial).rstrip("\r"))
+            self._partial = []
+        self.close_block()
+        candidates = [block for block in self.blocks
+                      if block.code and (block.filename or block.language in PYTHON_LANGUAGES)]
+        if not candidates:
+            return "".join(self.chunks)
+        return max(candidates, key=lambda block: (
+            self.filename is not None and block.filename == self.filename,
+            block.parses, block.size)).code
+
+
+def extract_code(answer: str, filename: Optional[str] = None) -> str:
+    """ The program of a complete answer, see CodeExtractor. """
+    extractor = CodeExtractor(filename)
+    extractor.feed(answer)
+    return extractor.finish()
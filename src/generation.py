@@ -0,0 +1,148 @@
+""" Concurrent generation of programs with the OpenAI chat completion API.
+
+Requests are sent concurrently, up to a concurrency limit, while staying
+under the requests and tokens per minute limits of the account. Rate
+limits and transient errors are retried with exponential backoff.
+"""
+
+import os
+import time
+import random
+import asyncio
+
+import openai
+
+
+# Errors after which the same request can simply be sent again
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+
+class TokenBucket():
+    """
+    Token bucket refilled continuously with per_minute tokens per minute,
+    holding at most a minute worth of tokens.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        """ Waits until amount tokens are available and takes them. """
+        amount = min(amount, self.capacity)
+        # asyncio primitives belong to one event loop, the bucket state is
+        # kept across runs (e.g. retry trials) but the lock is recreated
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        # Requests are served in order, a large one is not starved by small ones
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def consume(self, amount: float):
+        """ Takes amount tokens without waiting, the bucket can go in debt. """
+        self._refill()
+        self.tokens -= amount
+
+
+class GenerationEngine():
+    """
+    Sends chat completion requests concurrently while respecting the rate
+    limits of the account. Use api_base to target any OpenAI compatible
+    server, e.g. scripts/fake_openai_server.py.
+    """
+
+    def __init__(self, model: str = "gpt-3.5-turbo", concurrency: int = 16,
+                 requests_per_minute: float = 3500, tokens_per_minute: float = 90000,
+                 max_retries: int = 6, completion_tokens: int = 512,
+                 max_samples_per_request: int = 20,
+                 api_key=None, api_base=None, request_timeout: float = 120) -> None:
+        self.model = model
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        # Expected size of a completion, used to reserve tokens before a request
+        self.completion_tokens = completion_tokens
+        self.max_samples_per_request = max_samples_per_request
+        self.api_key = api_key or os.environ.get('OPEN_AI_KEY', None)
+        self.api_base = api_base
+        self.request_timeout = request_timeout
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._semaphore = None
+        self._loop = None
+
+    def estimate_tokens(self, prompt: str, n: int = 1) -> int:
+        """ Rough token count of a request, about 4 characters per token. """
+        return len(prompt) // 4 + n * self.completion_tokens
+
+    def backoff(self, attempt: int) -> float:
+        """ Exponential backoff with full jitter, capped to a minute. """
+        return random.uniform(0, min(60, 2 ** attempt))
+
+    async def generate(self, prompt: str, **parameters) -> str:
+        """ Returns the content of the answer of the model to prompt. """
+        response = await self.request(prompt, **parameters)
+        return response["choices"][0]["message"]["content"]
+
+    async def generate_many(self, prompt: str, n: int, **parameters) -> list:
+        """
+        Returns n answers of the model to prompt, asking for several answers
+        per request (at most max_samples_per_request).
+        """
+        answers = []
+        while len(answers) < n:
+            n_request = min(n - len(answers), self.max_samples_per_request)
+            response = await self.request(prompt, n=n_request, **parameters)
+            choices = sorted(response["choices"], key=lambda choice: choice["index"])
+            answers.extend(choice["message"]["content"] for choice in choices)
+        return answers
+
+    async def request(self, prompt: str, **parameters):
+        """ Sends prompt to the model, retrying on rate limits and transient errors. """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+
+        estimate = self.estimate_tokens(prompt, parameters.get("n", 1))
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                await self.requests.acquire()
+                await self.tokens.acquire(estimate)
+                try:
+                    response = await openai.ChatCompletion.acreate(
+                        model=self.model,
+                        messages=[{"role": "user", "content": prompt}],
+                        api_key=self.api_key,
+                        api_base=self.api_base,
+                        request_timeout=self.request_timeout,
+                        **parameters)
+                except RETRYABLE_ERRORS:
+                    if attempt == self.max_retries:
+                        raise
+                else:
+                    usage = response.get("usage", {}).get("total_tokens", estimate)
+                    self.tokens.consume(usage - estimate)
+                    return response
+            await asyncio.sleep(self.backoff(attempt))
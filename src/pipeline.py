@@ -0,0 +1,171 @@
+""" Streaming generate, grade and write pipeline.
+
+Generation, grading and writing run concurrently as stages connected by
+bounded queues. A full queue blocks the stage feeding it, so the number of
+rows in flight, hence the memory, does not depend on the dataset size.
+"""
+
+import os
+import math
+import time
+import asyncio
+import itertools
+from typing import Callable, Dict, Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StageMetrics():
+    """ Number of rows processed by a stage, and the time spent on them. """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.started = time.monotonic()
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.busy += seconds
+
+    def summary(self) -> Dict:
+        elapsed = time.monotonic() - self.started
+        return {"processed": self.count,
+                "throughput": self.count / elapsed if elapsed else 0.0,
+                "busy_seconds": self.busy}
+
+
+class QueueMetrics():
+    """
+    Bounded asyncio queue keeping track of its maximum depth. With a
+    priority function, the items with the lowest priority(item) are got
+    first (FIFO among equals), and the None end markers last.
+    """
+
+    def __init__(self, maxsize: int, priority: Optional[Callable] = None) -> None:
+        self.priority = priority
+        self.queue = asyncio.Queue(maxsize) if priority is None else asyncio.PriorityQueue(maxsize)
+        self._order = itertools.count()
+        self.max_depth = 0
+
+    async def put(self, item):
+        if self.priority is not None:
+            key = math.inf if item is None else self.priority(item)
+            item = (key, next(self._order), item)
+        await self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def get(self):
+        item = await self.queue.get()
+        return item if self.priority is None else item[2]
+
+    def summary(self) -> Dict:
+        return {"depth": self.queue.qsize(), "max_depth": self.max_depth,
+                "capacity": self.queue.maxsize}
+
+
+class Pipeline():
+    """
+    Pipeline of three stages:
+    * generate, an async function completing a row (e.g. with the code
+      generated by a model), run by n_generators tasks. It can return None
+      to drop the row, or a list of rows (e.g. one per sample).
+    * grade, a blocking function completing the row with its grading
+      results (e.g. with check_correctness), run by n_graders threads.
+    * write, a blocking function saving a finished row, run in order.
+
+    With a grade_priority function, the rows waiting to be graded are taken
+    by increasing grade_priority(row), e.g. longest expected grading first.
+    """
+
+    def __init__(self, generate: Callable, grade: Callable, write: Callable,
+                 n_generators: int = 16, n_graders: Optional[int] = None,
+                 queue_size: int = 64, report_every: Optional[float] = None,
+                 grade_priority: Optional[Callable] = None) -> None:
+        self.generate = generate
+        self.grade = grade
+        self.write = write
+        self.grade_priority = grade_priority
+        self.n_generators = n_generators
+        self.n_graders = n_graders or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.report_every = report_every
+        self.stages = {name: StageMetrics(name)
+                       for name in ("generate", "grade", "write")}
+        self.queues = {}
+
+    def metrics(self) -> Dict:
+        """ Per stage throughput and per queue depth. """
+        metrics = {name: stage.summary() for name, stage in self.stages.items()}
+        for name, queue in self.queues.items():
+            metrics[name + "_queue"] = queue.summary()
+        return metrics
+
+    async def run(self, rows: Iterable[Dict]):
+        """
+        Runs rows through the pipeline, rows is consumed lazily. An exception
+        raised by generate, grade or write stops the run and is raised.
+        """
+        rows = iter(rows)
+        self.stages = {name: StageMetrics(name) for name in self.stages}
+        self.queues = {"grade": QueueMetrics(self.queue_size, self.grade_priority),
+                       "write": QueueMetrics(self.queue_size)}
+        loop = asyncio.get_running_loop()
+
+        async def generator():
+            # rows is shared, the next row is only read when a task is free
+            for row in rows:
+                start = time.monotonic()
+                generated = await self.generate(row)
+                self.stages["generate"].add(time.monotonic() - start)
+                if generated is None:
+                    continue
+                for row in generated if isinstance(generated, list) else [generated]:
+                    await self.queues["grade"].put(row)
+
+        async def grader(executor):
+            while (row := await self.queues["grade"].get()) is not None:
+                start = time.monotonic()
+                row = await loop.run_in_executor(executor, self.grade, row)
+                self.stages["grade"].add(time.monotonic() - start)
+                await self.queues["write"].put(row)
+
+        async def writer():
+            while (row := await self.queues["write"].get()) is not None:
+                start = time.monotonic()
+                self.write(row)
+                self.stages["write"].add(time.monotonic() - start)
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(self.report_every)
+                print("pipeline", self.metrics())
+
+        with ThreadPoolExecutor(self.n_graders) as executor:
+            report = asyncio.ensure_future(reporter()) if self.report_every else None
+            generators = [asyncio.ensure_future(generator())
+                          for _ in range(self.n_generators)]
+            graders = [asyncio.ensure_future(grader(executor))
+                       for _ in range(self.n_graders)]
+            written = asyncio.ensure_future(writer())
+
+            async def end_stages():
+                await asyncio.gather(*generators)
+                for _ in graders:
+                    await self.queues["grade"].put(None)
+                await asyncio.gather(*graders)
+                await self.queues["write"].put(None)
+
+            ended = asyncio.ensure_future(end_stages())
+            tasks = generators + graders + [written, ended]
+            try:
+                # The first failure of a stage stops the others, which could
+                # otherwise wait forever on a queue nobody reads
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    if not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+            finally:
+                tasks = [task for task in tasks + [report] if task is not None]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
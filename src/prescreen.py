@@ -0,0 +1,255 @@
+""" Static checks of the generated programs, made in the parent before grading.
+
+A program that does not parse is scored 0 without a sandbox round trip, once
+its testcase was shown to score 0 a program that does not parse: the first
+such program of each testcase goes to the sandbox, and the next ones only
+skip it if that one completed with a score of 0. Their results are marked
+with exec_result "prescreened: <syntax error>". Some testcases give points to
+a traceback or fail on it, the programs of those testcases are always graded
+in the sandbox, as are the ones of testcases opening files (e.g. to read the
+source of the program).
+
+The other checks only flag programs likely to fail: uses of the functions
+and modules disabled by reliability_guard (they break the programs run in
+the sandbox process, see the inprocess backend) and programs reading no
+input while their testcase gives some.
+"""
+
+import ast
+import builtins
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from src.execution import (DISABLED_FUNCTIONS, DISABLED_MODULES, check_correctness,
+                           check_correctness_many, get_compiled_testcase)
+from src.utils.cache import Cache, content_hash
+from src.utils.code import get_ast, get_syntax_error
+
+DISABLED = {f"{module}.{function}" for module, functions in DISABLED_FUNCTIONS.items()
+            for function in functions}
+
+
+class QualifiedNames(ast.NodeVisitor):
+    """ Resolves the names of a module to what they were imported as, e.g. os.remove. """
+
+    def __init__(self) -> None:
+        self.aliases = {}
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            root = alias.name.split(".")[0]
+            self.aliases[alias.asname or root] = alias.name if alias.asname else root
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if node.module and not node.level:
+                self.aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+
+    def qualified(self, node) -> Optional[str]:
+        if isinstance(node, ast.Name):
+            if node.id in self.aliases:
+                return self.aliases[node.id]
+            return f"builtins.{node.id}" if hasattr(builtins, node.id) else node.id
+        if isinstance(node, ast.Attribute):
+            value = self.qualified(node.value)
+            return f"{value}.{node.attr}" if value is not None else None
+        return None
+
+
+class ProgramUses(QualifiedNames):
+    """ The disabled functions and modules a program uses, and whether it reads its input. """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.disabled = []
+        self.reads_input = False
+
+    def use(self, name):
+        if name not in self.disabled:
+            self.disabled.append(name)
+
+    def visit_Import(self, node):
+        super().visit_Import(node)
+        for alias in node.names:
+            if alias.name.split(".")[0] in DISABLED_MODULES:
+                self.use(alias.name)
+
+    def visit_ImportFrom(self, node):
+        super().visit_ImportFrom(node)
+        if node.module and not node.level and node.module.split(".")[0] in DISABLED_MODULES:
+            self.use(node.module)
+
+    def visit_Call(self, node):
+        name = self.qualified(node.func)
+        if name in DISABLED:
+            self.use(name)
+        self.generic_visit(node)
+
+    def visit_Name(self, node):
+        self.see(self.qualified(node))
+
+    def visit_Attribute(self, node):
+        self.see(self.qualified(node))
+        self.generic_visit(node)
+
+    def see(self, name):
+        if name and (name == "builtins.input" or name.startswith(("sys.stdin", "fileinput"))):
+            self.reads_input = True
+
+
+class TestcaseUses(QualifiedNames):
+    """ Whether a testcase gives inputs to the programs it runs, and whether it opens files. """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.gives_inputs = False
+        self.opens_files = False
+
+    def visit_Call(self, node):
+        name = self.qualified(node.func) or ""
+        if name.split(".")[-1] == "run_script":
+            inputs = node.args[1] if len(node.args) > 1 else next(
+                (keyword.value for keyword in node.keywords if keyword.arg == "input_list"), None)
+            if inputs is not None and not (isinstance(inputs, (ast.List, ast.Tuple)) and not inputs.elts):
+                self.gives_inputs = True
+        elif name in ("builtins.open", "io.open"):
+            self.opens_files = True
+        self.generic_visit(node)
+
+
+_testcase_uses = {}
+
+def testcase_uses(testcase: str) -> TestcaseUses:
+    """ TestcaseUses of a testcase, once per distinct testcase. """
+    key = content_hash(testcase)
+    uses = _testcase_uses.get(key)
+    if uses is None:
+        uses = TestcaseUses()
+        tree = get_ast(testcase)
+        if tree is not None:
+            uses.visit(tree)
+        _testcase_uses[key] = uses
+    return uses
+
+
+def prescreen(problem: Dict) -> Dict:
+    """
+    Static checks of the program of a problem: the syntax error the sandbox
+    would report (None when it parses), the disabled functions and modules
+    it uses, and whether it reads no input while its testcase gives some.
+    """
+    filename = problem["id"] + ".py"
+    tree = get_ast(problem["code"], filename)
+    if tree is None:
+        return {"syntax_error": get_syntax_error(problem["code"], filename),
+                "disabled": [], "missing_input": False}
+    uses = ProgramUses()
+    uses.visit(tree)
+    return {"syntax_error": None, "disabled": uses.disabled,
+            "missing_input": not uses.reads_input and testcase_uses(problem["testcase"]).gives_inputs}
+
+
+def prescreen_many(problems: Iterable[Dict]) -> List[Dict]:
+    """ prescreen of each problem, the repeated programs of a problem are checked once. """
+    screenings, done = [], {}
+    for problem in problems:
+        key = content_hash(problem["id"], problem["testcase"], problem["code"])
+        if key not in done:
+            done[key] = prescreen(problem)
+        screenings.append(done[key])
+    return screenings
+
+
+def describe(screening: Dict) -> str:
+    """ The issues found by prescreen, separated by semicolons, empty if none. """
+    issues = []
+    if screening["syntax_error"] is not None:
+        issues.append(f"syntax error: {screening['syntax_error']}")
+    issues += [f"disabled: {name}" for name in screening["disabled"]]
+    if screening["missing_input"]:
+        issues.append("reads no input")
+    return "; ".join(issues)
+
+
+# Whether the testcase scored 0 the first program that does not parse it
+# graded, by hash of the testcase
+_zero_testcases = {}
+
+def screened_result(problem: Dict, screening: Dict) -> Optional[Dict]:
+    """ The grading result of a problem decided by its screening, None if it needs the sandbox. """
+    if screening["syntax_error"] is None or not _zero_testcases.get(content_hash(problem["testcase"])):
+        return None
+    return {"exec_result": f"prescreened: {screening['syntax_error']}", "score": 0.0, "text": ""}
+
+
+def needs_evidence(problem: Dict, screening: Dict) -> bool:
+    """ Whether the sandbox result of the problem tells if its testcase can be prescreened. """
+    return (screening["syntax_error"] is not None
+            and content_hash(problem["testcase"]) not in _zero_testcases
+            and not testcase_uses(problem["testcase"]).opens_files)
+
+
+def observe(problem: Dict, screening: Dict, result: Dict):
+    """ Records whether the testcase scored 0 a program that does not parse, see needs_evidence. """
+    if needs_evidence(problem, screening) and result["exec_result"] != "timed out":
+        _zero_testcases[content_hash(problem["testcase"])] = (
+            result["exec_result"] == "completed" and result["score"] == 0)
+
+
+def check_screened(problem: Dict, completion: str, timeout: float,
+                   completion_id: Optional[int] = None, cache: Optional[Cache] = None) -> Dict:
+    """
+    check_correctness, for the problems prescreen cannot decide, with the
+    issues prescreen found in result["prescreen"].
+    """
+    screening = prescreen(problem)
+    result = screened_result(problem, screening)
+    if result is None:
+        result = check_correctness(problem, completion, timeout, completion_id, cache)
+        observe(problem, screening, result)
+    elif completion_id is not None:
+        result["completion_id"] = completion_id
+    result["prescreen"] = describe(screening)
+    return result
+
+
+def check_screened_many(problems: Iterable[Dict], timeout: float,
+                        n_workers: Optional[int] = None, cache: Optional[Cache] = None,
+                        **options) -> Iterator[Dict]:
+    """
+    check_correctness_many after screening the whole batch: the results
+    decided by prescreen come first, then the sandbox ones as they finish.
+    The programs that do not parse and whose testcase was not shown to
+    score them 0 yet wait for the first of them, see needs_evidence.
+    """
+    problems = [dict(problem, completion_id=problem.get("completion_id", i))
+                for i, problem in enumerate(problems)]
+    screenings = {problem["completion_id"]: screening
+                  for problem, screening in zip(problems, prescreen_many(problems))}
+    by_id = {problem["completion_id"]: problem for problem in problems}
+
+    def screened(problems):
+        """ Yields the decided results, and returns the problems left for the sandbox. """
+        misses, waiting, testcases = [], [], set()
+        for problem in problems:
+            screening = screenings[problem["completion_id"]]
+            result = screened_result(problem, screening)
+            if result is not None:
+                result["completion_id"] = problem["completion_id"]
+                result["prescreen"] = describe(screening)
+                yield result
+            elif needs_evidence(problem, screening) and problem["testcase"] in testcases:
+                waiting.append(problem)
+            else:
+                if needs_evidence(problem, screening):
+                    testcases.add(problem["testcase"])
+                misses.append(problem)
+        return misses, waiting
+
+    waiting = problems
+    while waiting:
+        misses, waiting = yield from screened(waiting)
+        for result in check_correctness_many(misses, timeout, n_workers, cache, **options):
+            problem = by_id[result["completion_id"]]
+            observe(problem, screenings[problem["completion_id"]], result)
+            result["prescreen"] = describe(screenings[problem["completion_id"]])
+            yield result
@@ -0,0 +1,192 @@
+""" Cost estimates and longest-expected-first ordering of grading jobs.
+
+Most FalconCode testcases run the student program once or twice and finish
+in milliseconds, some run it many times or legitimately take seconds.
+Dispatching the expensive jobs first keeps a parallel grader from ending
+with a tail of stragglers, and the per-problem timeouts let the fast
+problems give up on runaway programs early.
+"""
+
+import ast
+import collections
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from src.execution import check_correctness_many
+from src.utils.cache import Cache
+
+# The timeouts given to the jobs, a few values keep the cache keys stable
+TIMEOUTS = (1.0, 2.0, 5.0, 10.0, 20.0)
+# Rough time of a run_script call, mostly the interpreter start
+SECONDS_PER_RUN = 0.1
+# Least timeout per run_script call, whatever the history, the load of the
+# machine can make a fast program much slower
+MIN_SECONDS_PER_RUN = 1.0
+# Completed jobs of a problem needed before its timeout goes below the default
+MIN_OBSERVATIONS = 3
+# Loops over something else than a literal or a constant range
+UNKNOWN_ITERATIONS = 3
+
+
+class ScriptRuns(ast.NodeVisitor):
+    """ Counts the run_script calls of a testcase, multiplied by the iterations of their loops. """
+
+    def __init__(self) -> None:
+        self.runs = 0
+        self.multiplier = 1
+
+    def visit_For(self, node):
+        iterations = loop_iterations(node.iter)
+        self.multiplier *= iterations
+        for child in node.body:
+            self.visit(child)
+        self.multiplier //= iterations
+        for child in node.orelse:
+            self.visit(child)
+
+    def visit_While(self, node):
+        self.multiplier *= UNKNOWN_ITERATIONS
+        for child in node.body:
+            self.visit(child)
+        self.multiplier //= UNKNOWN_ITERATIONS
+
+    def visit_Call(self, node):
+        function = node.func
+        name = function.attr if isinstance(function, ast.Attribute) else getattr(function, "id", None)
+        if name == "run_script":
+            self.runs += self.multiplier
+        self.generic_visit(node)
+
+
+def loop_iterations(node) -> int:
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return max(len(node.elts), 1)
+    if (isinstance(node, ast.Call) and getattr(node.func, "id", None) == "range"
+            and node.args and all(isinstance(arg, ast.Constant) and isinstance(arg.value, int)
+                                  for arg in node.args)):
+        return max(len(range(*[arg.value for arg in node.args])), 1)
+    return UNKNOWN_ITERATIONS
+
+
+def count_script_runs(testcase: str) -> int:
+    """ Static estimate of the number of programs a testcase runs, at least 1. """
+    try:
+        tree = ast.parse(testcase)
+    except (SyntaxError, ValueError):
+        return 1
+    visitor = ScriptRuns()
+    visitor.visit(tree)
+    return max(visitor.runs, 1)
+
+
+class CostModel():
+    """
+    Expected grading seconds and timeout of each problem. Problems without
+    history are estimated from their number of run_script calls, and get
+    the default timeout. Once min_observations jobs of a problem completed,
+    its timeout is slack times the slowest of them (wall time), but at
+    least MIN_SECONDS_PER_RUN per run_script call. Jobs that timed out
+    bring it back to the default, and above it when they timed out at the
+    default. Timeouts are rounded up to one of TIMEOUTS.
+    """
+
+    def __init__(self, default_timeout: float = 5.0, slack: float = 3.0,
+                 timeouts=TIMEOUTS, seconds_per_run: float = SECONDS_PER_RUN,
+                 min_observations: int = MIN_OBSERVATIONS) -> None:
+        self.default_timeout = default_timeout
+        self.slack = slack
+        self.timeouts = sorted(timeouts)
+        self.seconds_per_run = seconds_per_run
+        self.min_observations = min_observations
+        self.completed = collections.defaultdict(list)
+        self.timed_out = collections.Counter()
+        # Largest timeout a job of the problem reached
+        self.timed_out_at = {}
+        self._runs = {}
+
+    def script_runs(self, problem: Dict) -> int:
+        testcase = problem["testcase"]
+        if testcase not in self._runs:
+            self._runs[testcase] = count_script_runs(testcase)
+        return self._runs[testcase]
+
+    def observe(self, problem_id, result: Dict, timeout: Optional[float] = None):
+        """
+        Adds the grading result of a job of the problem, graded with timeout
+        (by default the "timeout" of the result, e.g. a run_openai row), to
+        the history. Results without wall time, e.g. cached ones, only count
+        when they timed out.
+        """
+        if result["exec_result"] == "timed out":
+            timeout = timeout or result.get("timeout") or self.default_timeout
+            self.timed_out[problem_id] += 1
+            self.timed_out_at[problem_id] = max(timeout, self.timed_out_at.get(problem_id, 0))
+            return
+        seconds = job_seconds(result)
+        if seconds is not None:
+            self.completed[problem_id].append(seconds)
+
+    def observe_results(self, rows: Iterable[Dict]):
+        """ observe for rows holding the problem id and its result, e.g. checkpoint rows. """
+        for row in rows:
+            if "exec_result" in row:
+                self.observe(row["id"], row)
+
+    def expected_seconds(self, problem: Dict) -> float:
+        seconds = self.completed.get(problem["id"])
+        if seconds:
+            # Jobs that timed out would have taken at least their timeout
+            n_timed_out = self.timed_out[problem["id"]]
+            return ((sum(seconds) + n_timed_out * self.timeout(problem))
+                    / (len(seconds) + n_timed_out))
+        return self.script_runs(problem) * self.seconds_per_run
+
+    def timeout(self, problem: Dict) -> float:
+        runs = self.script_runs(problem)
+        seconds = self.completed.get(problem["id"], [])
+        if problem["id"] in self.timed_out_at:
+            reached = self.timed_out_at[problem["id"]]
+            if reached >= self.default_timeout:
+                # The next timeout, jobs timed out at the default one
+                return next((timeout for timeout in self.timeouts if timeout > reached),
+                            self.timeouts[-1])
+            needed = self.default_timeout
+        elif len(seconds) >= self.min_observations:
+            needed = max(self.slack * max(seconds), MIN_SECONDS_PER_RUN * runs)
+        else:
+            needed = max(self.default_timeout, self.slack * runs * self.seconds_per_run)
+        return next((timeout for timeout in self.timeouts if timeout >= needed), self.timeouts[-1])
+
+    def schedule(self, problems: Iterable[Dict]) -> List[Dict]:
+        """ The problems with their timeout set, the longest expected first. """
+        problems = [dict(problem, timeout=self.timeout(problem)) for problem in problems]
+        return sorted(problems, key=self.expected_seconds, reverse=True)
+
+
+def job_seconds(result: Dict) -> Optional[float]:
+    """ Wall seconds of a job graded by a sandbox worker, None for cached results. """
+    if result.get("wall_seconds") is not None:
+        return result["wall_seconds"]
+    profile = result.get("profile")
+    if isinstance(profile, dict) and "round_trip" in profile:
+        return profile["round_trip"]
+    return None
+
+
+def grade_scheduled(problems: Iterable[Dict], model: CostModel,
+                    n_workers: Optional[int] = None, cache: Optional[Cache] = None,
+                    **options) -> Iterator[Dict]:
+    """
+    check_correctness_many over the problems in longest-expected-first
+    order, each with its own timeout. The results, tagged with the
+    completion_id of their problem (or its position in problems), are
+    added to the model history as they come.
+    """
+    problems = [dict(problem, completion_id=problem.get("completion_id", i))
+                for i, problem in enumerate(problems)]
+    ids = {problem["completion_id"]: problem["id"] for problem in problems}
+    scheduled = model.schedule(problems)
+    timeouts = {problem["completion_id"]: problem["timeout"] for problem in scheduled}
+    for result in check_correctness_many(scheduled, model.default_timeout,
+                                         n_workers, cache, **options):
+        model.observe(ids[result["completion_id"]], result, timeouts[result["completion_id"]])
+        yield result
@@ -2,14 +2,22 @@ import __main__ as main
 
 from colorama import Fore, Back, Style
 
+import contextlib
 import getpass
 import hashlib
+import io
+import math
 import os
 import py_compile
 import requests
+import select
+import selectors
 import shutil
+import signal
 import subprocess
 import sys
+import time
+import traceback
 
 
 # ---------------------------------------------------------------------
@@ -127,6 +135,308 @@ def get_inputs(input_list):
     return result
 
 
+# -------------------------------------------------------------
+# Raised when a script run in-process exceeds its time limit
+# -------------------------------------------------------------
+class ScriptTimeout(Exception):
+    pass
+
+
+# -------------------------------------------------------------
+# Raises ScriptTimeout after the given number of seconds
+# No seconds (None) only keeps the enclosing timer, and no time left (0 or
+# False, like some testcases pass) times out at once, like Popen.communicate
+# An enclosing timer (e.g. the grading sandbox one) is restored after, or
+# fires right away when its deadline passed
+# -------------------------------------------------------------
+@contextlib.contextmanager
+def time_limit(seconds):
+    def signal_handler(signum, frame):
+        raise ScriptTimeout("Timed out!")
+    if seconds is not None and seconds <= 0:
+        raise ScriptTimeout("Timed out!")
+    start = time.monotonic()
+    previous_handler = signal.signal(signal.SIGALRM, signal_handler)
+    remaining, _ = signal.getitimer(signal.ITIMER_REAL)
+    if seconds is None:
+        seconds = remaining
+    elif remaining:
+        seconds = min(seconds, remaining)
+    # A zero timer would disarm the enclosing one
+    if seconds:
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if remaining:
+            left = remaining - (time.monotonic() - start)
+            if left <= 0 and callable(previous_handler):
+                # The enclosing deadline passed too, its timeout is raised
+                # here instead of ScriptTimeout
+                previous_handler(signal.SIGALRM, None)
+            signal.setitimer(signal.ITIMER_REAL, max(left, 1e-6))
+
+
+# -------------------------------------------------------------
+# Raised when a program run in-process prints more than its output limit
+# -------------------------------------------------------------
+class OutputLimitExceeded(BaseException):
+    pass
+
+
+# -------------------------------------------------------------
+# StringIO raising OutputLimitExceeded once more than limit characters
+# were written to it (the characters up to the limit are kept)
+# -------------------------------------------------------------
+class LimitedStringIO(io.StringIO):
+    def __init__(self, limit=None):
+        super().__init__()
+        self.limit = limit
+        self.size = 0
+
+    def write(self, s):
+        if self.limit is not None and self.size + len(s) > self.limit:
+            super().write(s[:self.limit - self.size])
+            self.size = self.limit
+            raise OutputLimitExceeded("output limit exceeded")
+        self.size += len(s)
+        return super().write(s)
+
+
+# -------------------------------------------------------------
+# Limits of the programs run by run_script, set by the grading sandbox
+# through AUTOGRADER_MEMORY_LIMIT (bytes), AUTOGRADER_CPU_LIMIT (seconds)
+# and AUTOGRADER_OUTPUT_LIMIT (characters), None when not set
+# -------------------------------------------------------------
+def get_limits():
+    limits = {}
+    for name, kind in (("memory", int), ("cpu", float), ("output", int)):
+        value = os.environ.get('AUTOGRADER_' + name.upper() + '_LIMIT')
+        limits[name] = kind(float(value)) if value else None
+    return limits
+
+
+prlimit = shutil.which("prlimit")
+
+
+# -------------------------------------------------------------
+# Prefixes the command with prlimit to apply the memory and CPU time limits
+# Without prlimit, the programs inherit the memory limit of the sandbox, and
+# cpu_limit_setter gives them their CPU time limit (the one they would
+# inherit counts the CPU time the sandbox used)
+# -------------------------------------------------------------
+def limited_command(command, limits):
+    options = []
+    if limits["memory"]:
+        options.append("--as=" + str(int(limits["memory"])))
+    if limits["cpu"]:
+        seconds = math.ceil(limits["cpu"])
+        options.append("--cpu=" + str(seconds) + ":" + str(seconds + 1))
+    if options and prlimit:
+        return [prlimit] + options + ["--"] + command
+    return command
+
+
+# -------------------------------------------------------------
+# Returns a preexec_fn setting the CPU time limit of a program in its own
+# process, None when limited_command applies it or there is no limit
+# -------------------------------------------------------------
+def cpu_limit_setter(limits):
+    if not limits["cpu"] or prlimit:
+        return None
+    resource = import_resource()
+    seconds = math.ceil(limits["cpu"])
+
+    def set_cpu_limit():
+        # The hard limit cannot be raised, only lowered
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        if hard == resource.RLIM_INFINITY:
+            hard = seconds + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (min(seconds, hard), min(seconds + 1, hard)))
+    return set_cpu_limit
+
+
+# -------------------------------------------------------------
+# Imports the resource module, also inside the grading sandbox which blocks
+# its import (the module itself is not given to the programs it grades)
+# -------------------------------------------------------------
+def import_resource():
+    blocked = "resource" in sys.modules and sys.modules["resource"] is None
+    if blocked:
+        del sys.modules["resource"]
+    try:
+        import resource
+    finally:
+        if blocked:
+            sys.modules["resource"] = None
+    return resource
+
+
+# -------------------------------------------------------------
+# Largest peak resident memory (bytes) of the programs run in subprocesses
+# since the grading sandbox set it to 0, not recorded when it is None
+# -------------------------------------------------------------
+script_peak_rss = None
+
+
+# -------------------------------------------------------------
+# Same as p.wait, but reaps the process with os.wait4 to record its peak
+# memory in script_peak_rss (where pidfds exist, p.wait is used elsewhere)
+# -------------------------------------------------------------
+def wait_process(p, timeout=None):
+    global script_peak_rss
+    if p.returncode is not None or not hasattr(os, "pidfd_open"):
+        return p.wait(timeout)
+    if timeout is not None:
+        fd = os.pidfd_open(p.pid)
+        try:
+            ready, _, _ = select.select([fd], [], [], max(timeout, 0))
+        finally:
+            os.close(fd)
+        if not ready:
+            raise subprocess.TimeoutExpired(p.args, timeout)
+    # os.wait4 imports resource, which the grading sandbox blocks
+    blocked = "resource" in sys.modules and sys.modules["resource"] is None
+    if blocked:
+        del sys.modules["resource"]
+    try:
+        _, status, usage = os.wait4(p.pid, 0)
+    finally:
+        if blocked:
+            sys.modules["resource"] = None
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if script_peak_rss is not None:
+        # ru_maxrss is in kilobytes on Linux
+        script_peak_rss = max(script_peak_rss, usage.ru_maxrss * 1024)
+    return p.returncode
+
+
+# -------------------------------------------------------------
+# Kills and reaps a subprocess, also inside the grading sandbox where
+# os.kill is disabled (the signal is then sent through a pidfd)
+# -------------------------------------------------------------
+def kill_process(p):
+    try:
+        p.kill()
+    except TypeError:
+        fd = os.pidfd_open(p.pid)
+        try:
+            signal.pidfd_send_signal(fd, signal.SIGKILL)
+        finally:
+            os.close(fd)
+    wait_process(p)
+    for stream in (p.stdin, p.stdout, p.stderr):
+        if stream:
+            stream.close()
+
+
+# -------------------------------------------------------------
+# Same as p.communicate, but kills the process once it wrote more than
+# limit characters, the output is then truncated to the limit
+# Returns (out, err, exceeded)
+# -------------------------------------------------------------
+def communicate(p, input_bytes, timeout_in_seconds, limit=None):
+    if limit is None:
+        out, err = p.communicate(input=input_bytes, timeout=timeout_in_seconds)
+        return out, err, False
+
+    deadline = time.monotonic() + timeout_in_seconds
+    try:
+        p.stdin.write(input_bytes)
+        p.stdin.close()
+    except BrokenPipeError:
+        pass
+
+    chunks = {p.stdout.fileno(): [], p.stderr.fileno(): []}
+    size, exceeded = 0, False
+    with selectors.DefaultSelector() as selector:
+        for fd in chunks:
+            selector.register(fd, selectors.EVENT_READ)
+        while selector.get_map() and not exceeded:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(p.args, timeout_in_seconds)
+            for key, _ in selector.select(remaining):
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fd)
+                    continue
+                chunks[key.fd].append(data)
+                size += len(data)
+                if size > limit:
+                    exceeded = True
+                    break
+
+    if exceeded:
+        kill_process(p)
+    else:
+        wait_process(p, max(deadline - time.monotonic(), 0))
+        p.stdout.close()
+        p.stderr.close()
+
+    # Decoded and with universal newlines, like in text mode
+    out, err = [b"".join(chunks[fd]).decode(errors="replace")
+                .replace("\r\n", "\n").replace("\r", "\n") for fd in chunks]
+    if exceeded:
+        out = out[:limit]
+        err = err[:max(limit - len(out), 0)]
+    return out, err, exceeded
+
+
+# Code objects of the scripts run in-process, by filename and source
+compiled_scripts = {}
+
+# Timings of the run_script calls, recorded only when the grading sandbox
+# sets it to a list: (seconds to start the program, seconds it ran,
+# whether it ran in a subprocess) per call
+script_timings = None
+
+
+# -------------------------------------------------------------
+# Runs a Python File inside the current process
+# Only meant for an already isolated process such as a grading sandbox
+# worker, which enables it with AUTOGRADER_BACKEND=inprocess
+# -------------------------------------------------------------
+def run_script_inprocess(filename, input_bytes, timeout_in_seconds, output_limit=None):
+    with open(filename, "r") as fp:
+        source = fp.read()
+
+    stdout, stderr = LimitedStringIO(output_limit), LimitedStringIO(output_limit)
+    try:
+        if (filename, source) not in compiled_scripts:
+            compiled_scripts[(filename, source)] = compile(source, filename, "exec")
+        code = compiled_scripts[(filename, source)]
+    except SyntaxError as e:
+        stderr.write("".join(traceback.format_exception_only(type(e), e)))
+        return '', stderr.getvalue()
+
+    # exit and quit may have been disabled in the sandbox
+    namespace = {"__name__": "__main__", "__file__": filename,
+                 "exit": sys.exit, "quit": sys.exit}
+    streams = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin, sys.stdout, sys.stderr = io.StringIO(input_bytes), stdout, stderr
+    try:
+        with time_limit(timeout_in_seconds):
+            exec(code, namespace)
+    except ScriptTimeout:
+        raise
+    except OutputLimitExceeded:
+        stderr.limit = None
+        stderr.write("\nOutput limit of " + str(output_limit) + " characters exceeded.")
+    except SystemExit as e:
+        if e.code is not None and not isinstance(e.code, int):
+            stderr.write(str(e.code) + "\n")
+    except (Exception, KeyboardInterrupt) as e:
+        # Skips the frame of this function, like the interpreter would
+        stderr.write("".join(traceback.format_exception(type(e), e, e.__traceback__.tb_next)))
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = streams
+
+    return stdout.getvalue(), stderr.getvalue()
+
+
 # -------------------------------------------------------------
 # Runs a Python File with the Provided Inputs
 # Flags let you specify what outputs, if any, to provide
@@ -149,20 +459,44 @@ def run_script(filename, input_list=[], timeout_in_seconds=5):
     # Converts the Input to Bytes
     input_bytes = get_inputs(input_list)
 
+    limits = get_limits()
+    inprocess = os.environ.get('AUTOGRADER_BACKEND') == 'inprocess'
+    started = spawned = time.monotonic()
     try:
-        # Executes a Subprocess that runs the script with the specified inputs
-        p = subprocess.Popen([sys.executable, filename],
-                             universal_newlines=True, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             env=dict(os.environ, DISABLE_AUTOGRADER='1'))
-        out, err = p.communicate(input=input_bytes, timeout=timeout_in_seconds)
-    except subprocess.TimeoutExpired:
+        if inprocess:
+            out, err = run_script_inprocess(filename, input_bytes, timeout_in_seconds,
+                                            limits["output"])
+        else:
+            # Executes a Subprocess that runs the script with the specified inputs
+            p = subprocess.Popen(limited_command([sys.executable, filename], limits),
+                                 universal_newlines=True, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 env=dict(os.environ, DISABLE_AUTOGRADER='1'),
+                                 preexec_fn=cpu_limit_setter(limits))
+            spawned = time.monotonic()
+            try:
+                out, err, exceeded = communicate(p, input_bytes, timeout_in_seconds,
+                                                 limits["output"])
+            except BaseException:
+                # Also when the grading sandbox interrupts the test
+                kill_process(p)
+                raise
+            if exceeded:
+                err += ("\nOutput limit of " + str(limits["output"]) +
+                        " characters exceeded.")
+            elif limits["cpu"] and p.returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+                err += ("\nExceeded the CPU time limit of " +
+                        str(math.ceil(limits["cpu"])) + " seconds.")
+    except (subprocess.TimeoutExpired, ScriptTimeout):
         out = ''
         err = ('Timed out after ' + str(timeout_in_seconds) + ' seconds.  '
                'This can occur when your program asks for more inputs than the '
                'test case provides, or when you have a loop that does not '
                'end.')
 
+    if script_timings is not None:
+        script_timings.append((spawned - started, time.monotonic() - spawned, not inprocess))
+
     # Prints out the Program's Output
     if show_output:
         print_styled(Style.BRIGHT, "Your Program's Output:")
@@ -0,0 +1,155 @@
+""" Persistent caches shared by the grading and the data loading code """
+
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def content_hash(*parts) -> str:
+    """ Hashes the string representation of the given parts. """
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def file_hash(path) -> str:
+    """ Hashes the contents of a file. """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Cache():
+    """
+    On-disk key-value cache of JSON serializable values backed by SQLite.
+    The least recently used entries are evicted once the stored values
+    exceed max_bytes, their total is kept up to date by triggers so that
+    storing does not scan the table. The cache can be shared by threads and
+    processes.
+    """
+
+    # Updates the size of a replaced entry, which fires the update trigger
+    # (the deletions of INSERT OR REPLACE do not fire the delete one)
+    UPSERT = ("INSERT INTO cache VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+              "value = excluded.value, size = excluded.size, accessed = excluded.accessed")
+
+    def __init__(self, path, max_bytes: int = 1 << 30) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key TEXT PRIMARY KEY, value TEXT, "
+                         "size INTEGER, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed "
+                         "ON cache (accessed)")
+        self._db.commit()
+        # One transaction, the total of an existing cache is computed once
+        # with the triggers that keep it up to date from then on
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache_total (bytes INTEGER)")
+            if self._db.execute("SELECT 1 FROM cache_total").fetchone() is None:
+                self._db.execute("INSERT INTO cache_total "
+                                 "SELECT COALESCE(SUM(size), 0) FROM cache")
+            self._db.execute("CREATE TRIGGER IF NOT EXISTS cache_inserted AFTER INSERT ON cache "
+                             "BEGIN UPDATE cache_total SET bytes = bytes + NEW.size; END")
+            self._db.execute("CREATE TRIGGER IF NOT EXISTS cache_updated AFTER UPDATE OF size ON cache "
+                             "BEGIN UPDATE cache_total SET bytes = bytes + NEW.size - OLD.size; END")
+            self._db.execute("CREATE TRIGGER IF NOT EXISTS cache_deleted AFTER DELETE ON cache "
+                             "BEGIN UPDATE cache_total SET bytes = bytes - OLD.size; END")
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM cache WHERE key = ?",
+                                   (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._db.execute("UPDATE cache SET accessed = ? WHERE key = ?",
+                             (time.time(), key))
+            self._db.commit()
+        return json.loads(row[0])
+
+    def get_many(self, keys) -> dict:
+        """ Returns the cached values of keys, in a single transaction. """
+        found = {}
+        with self._lock:
+            for key in keys:
+                row = self._db.execute("SELECT value FROM cache WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is not None:
+                    found[key] = json.loads(row[0])
+            now = time.time()
+            self._db.executemany("UPDATE cache SET accessed = ? WHERE key = ?",
+                                 [(now, key) for key in found])
+            self._db.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: dict):
+        """ Stores all the key, value pairs of items in a single transaction. """
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+        with self._lock:
+            self._db.executemany(self.UPSERT, rows)
+            self._evict()
+            self._db.commit()
+
+    def put(self, key, value):
+        value = json.dumps(value)
+        with self._lock:
+            self._db.execute(self.UPSERT, (key, value, len(value), time.time()))
+            self._evict()
+            self._db.commit()
+
+    def _total(self) -> int:
+        return self._db.execute("SELECT bytes FROM cache_total").fetchone()[0]
+
+    def _evict(self):
+        size = self._total()
+        if size <= self.max_bytes:
+            return
+        # Only the least recently used rows needed are read
+        rows = self._db.execute("SELECT key, size FROM cache ORDER BY accessed")
+        evicted = []
+        for key, value_size in rows:
+            if size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            size -= value_size
+        rows.close()
+        self._db.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM cache WHERE key = ?",
+                                    (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        """ Returns the hit and miss counters and the size of the cache. """
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            size = self._total()
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": entries, "bytes": size}
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,94 @@
+""" Crash-safe incremental saving of result rows """
+
+import os
+import json
+import time
+
+
+def to_builtin(value):
+    """ json default converting the numpy scalars of pandas rows """
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def read_jsonl(path):
+    """ Yields the rows of a JSONL file, ignoring a truncated last line. """
+    with open(path, "r") as fp:
+        for line in fp:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+class Checkpoint():
+    """
+    Append-only JSONL file of finished rows. Every row is handed to the OS
+    as soon as it is appended, and the file is fsynced every fsync_every
+    rows or fsync_interval seconds, whichever comes first.
+
+    With resume=True, the rows already in the file are kept and their keys
+    are available in self.keys, so that a restarted run can skip them.
+    Otherwise a non-empty file is never overwritten: it raises
+    FileExistsError, unless restart=True which renames it aside first.
+    """
+
+    def __init__(self, path, resume: bool = False, key=lambda row: row["id"],
+                 fsync_every: int = 32, fsync_interval: float = 5.0,
+                 restart: bool = False) -> None:
+        self.path = path
+        self.key = key
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.keys = set()
+        if resume and os.path.exists(path):
+            self._recover()
+        elif not resume and os.path.exists(path) and os.path.getsize(path):
+            if not restart:
+                raise FileExistsError(f"{path} already holds rows, resume or restart it")
+            os.replace(path, f"{path}.{time.strftime('%Y%m%d-%H%M%S')}.bak")
+        self._fp = open(path, "a" if resume else "w")
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def _recover(self):
+        """ Loads the keys of the saved rows and drops a partially written one. """
+        offset = 0
+        with open(self.path, "rb") as fp:
+            for line in fp:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("truncated row")
+                    self.keys.add(self.key(json.loads(line)))
+                except ValueError:
+                    break
+                offset += len(line)
+        with open(self.path, "rb+") as fp:
+            fp.truncate(offset)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def append(self, row):
+        self._fp.write(json.dumps(row, default=to_builtin) + "\n")
+        self._fp.flush()
+        self.keys.add(self.key(row))
+        self._unsynced += 1
+        if (self._unsynced >= self.fsync_every
+                or time.monotonic() - self._synced_at >= self.fsync_interval):
+            self.sync()
+
+    def sync(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        if not self._fp.closed:
+            self.sync()
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -3,8 +3,16 @@ import ast
 def does_compile(code):
     return get_ast(code) is not None
 
-def get_ast(code):
+def get_ast(code, filename="<unknown>"):
     try:
-        return ast.parse(code)
-    except:
-        return None 
\ No newline at end of file
+        return ast.parse(code, filename)
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+
+def get_syntax_error(code, filename="<unknown>"):
+    """ The message of the error raised when parsing code, None if it parses. """
+    try:
+        ast.parse(code, filename)
+    except (SyntaxError, ValueError, RecursionError) as e:
+        return str(e)
+    return None
@@ -0,0 +1,241 @@
+"""
+Renders HTML tables as fixed-width text directly from the BeautifulSoup tree.
+
+The output is the one of pd.read_html(str(el))[0].fillna("").to_string()
+(with the 'Unnamed: 0' column renamed to ''). Tables whose rendering would
+depend on the pandas type inference (floats, booleans, missing values, ...)
+are not handled here: render_table returns None and the caller falls back
+to pandas.
+"""
+
+import re
+from typing import List, Optional
+from bs4 import CData, NavigableString, Tag
+
+# Same whitespace normalization as pandas.io.html
+WHITESPACE = re.compile(r"[\r\n]+|\s{2,}")
+INTEGER = re.compile(r"[+-]?[0-9]+")
+# Default pandas missing value markers ("" is handled separately)
+NA_VALUES = {"-1.#IND", "1.#QNAN", "1.#IND", "-1.#QNAN", "#N/A N/A", "#N/A",
+             "N/A", "n/a", "NA", "<NA>", "#NA", "NULL", "null", "NaN", "-NaN",
+             "nan", "-nan", "None"}
+BOOL_VALUES = {"True", "TRUE", "true", "False", "FALSE", "false"}
+# Characters pandas escapes when printing
+ESCAPED = re.compile(r"[\t\r\n]")
+
+
+class Unsupported(Exception):
+    """ The table needs pandas to be rendered identically """
+
+
+def render_table(el) -> Optional[str]:
+    """ Renders the <table> element el, or returns None if it is unsupported. """
+    try:
+        header, body = parse_table(el)
+        if not body:
+            # pandas fails on tables without rows, they are dropped
+            return ""
+        return layout(*infer_columns(header, body))
+    except Unsupported:
+        return None
+
+
+def parse_table(el):
+    """ Returns the header row (or None) and the body rows of the table. """
+    if is_hidden(el):
+        raise Unsupported()
+    # A single walk over the tree, the bs4 find methods are comparatively slow
+    thead, tbody, root, tfoot = [], [], [], []
+    for node in el.descendants:
+        if not isinstance(node, Tag):
+            continue
+        if node.name == "table" or is_hidden(node):
+            raise Unsupported()
+        if node.name == "thead" and cells(node):
+            raise Unsupported()
+        if node.name != "tr":
+            continue
+        if node.parent is el:
+            root.append(node)
+        elif node.parent.name == "thead":
+            thead.append(node)
+        sections = {parent.name for parent in node.parents if parent is not el}
+        if "tbody" in sections:
+            tbody.append(node)
+        if "tfoot" in sections:
+            tfoot.append(node)
+
+    body_rows = tbody + root
+    if not (thead or body_rows or tfoot):
+        return None, []
+    if not thead:
+        # Leading rows made only of <th> cells form the header
+        while body_rows and all(cell.name == "th" for cell in cells(body_rows[0])):
+            thead.append(body_rows.pop(0))
+
+    head = expand_spans(thead)
+    rows = head + expand_spans(body_rows) + expand_spans(tfoot)
+    if len(head) > 1 or len(rows) <= len(head):
+        raise Unsupported()
+
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    if not any(any(row) for row in rows) or (width == 1 and not all(row[0] for row in rows)):
+        # Blank lines are dropped by the pandas parser
+        raise Unsupported()
+    if head:
+        if not any(rows[0]):
+            raise Unsupported()
+        return rows[0], rows[1:]
+    return None, rows
+
+
+def is_hidden(node) -> bool:
+    style = node.get("style")
+    return style is not None and "display:none" in str(style).replace(" ", "")
+
+
+def cells(tr) -> List[Tag]:
+    return [node for node in tr.children
+            if isinstance(node, Tag) and node.name in ("td", "th")]
+
+
+def cell_text(cell) -> str:
+    parts = []
+    for node in cell.descendants:
+        if isinstance(node, Tag):
+            if node.name in ("td", "th", "tr"):
+                raise Unsupported()
+            if node.name == "br":
+                parts.append("\n")
+        elif type(node) in (NavigableString, CData):
+            parts.append(str(node))
+    return WHITESPACE.sub(" ", "".join(parts).strip())
+
+
+def span(cell, attribute) -> int:
+    try:
+        value = int(cell.get(attribute) or 1)
+    except (TypeError, ValueError):
+        raise Unsupported()
+    if value < 1:
+        raise Unsupported()
+    return value
+
+
+def expand_spans(rows) -> List[List[str]]:
+    """ Copies the text of cells spanning several rows or columns, like pandas. """
+    texts_per_row = []
+    remainder = []  # (column index, text, rows left)
+    for tr in rows:
+        texts, next_remainder = [], []
+        index = 0
+        for cell in cells(tr):
+            while remainder and remainder[0][0] <= index:
+                prev_index, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+                index += 1
+            text = cell_text(cell)
+            rowspan, colspan = span(cell, "rowspan"), span(cell, "colspan")
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    next_remainder.append((index, text, rowspan - 1))
+                index += 1
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+        texts_per_row.append(texts)
+        remainder = next_remainder
+
+    while remainder:
+        texts, next_remainder = [], []
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+        texts_per_row.append(texts)
+        remainder = next_remainder
+
+    return texts_per_row
+
+
+def infer_columns(header, body):
+    """ Returns the column names and the formatted values of every column. """
+    width = len(body[0])
+    if header is None:
+        names = [str(i) for i in range(width)]
+    else:
+        names = [name if name else f"Unnamed: {i}" for i, name in enumerate(header)]
+        names = mangle_duplicates(names)
+        if names[0] == "Unnamed: 0":
+            names[0] = ""
+    if any(ESCAPED.search(name) for name in names):
+        raise Unsupported()
+
+    columns = []
+    for i in range(width):
+        values = [row[i] for row in body]
+        integers = 0
+        for value in values:
+            if value in NA_VALUES or value in BOOL_VALUES or ESCAPED.search(value):
+                raise Unsupported()
+            if INTEGER.fullmatch(value):
+                integers += 1
+            elif is_numeric(value):
+                raise Unsupported()
+        if integers == len(values):
+            parsed = [int(value) for value in values]
+            if any(abs(value) >= 2 ** 63 for value in parsed):
+                raise Unsupported()
+            # Signed format, positive integers get a leading space
+            columns.append([f"{value: d}" for value in parsed])
+            # So do the names of numeric columns
+            names[i] = " " + names[i]
+        elif integers and "" in values:
+            # Mixes of integers and missing values become floats
+            raise Unsupported()
+        else:
+            # Strings are printed with a leading space
+            columns.append([" " + value for value in values])
+    return names, columns
+
+
+def is_numeric(value: str) -> bool:
+    """ Whether pandas could parse value as a number (thousands separators included). """
+    try:
+        float(value.replace(",", ""))
+    except ValueError:
+        return False
+    return True
+
+
+def mangle_duplicates(names):
+    seen, mangled = {}, []
+    for name in names:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        mangled.append(f"{name}.{count}" if count else name)
+    if len(set(mangled)) != len(mangled):
+        raise Unsupported()
+    return mangled
+
+
+def layout(names, columns) -> str:
+    """ Same layout as DataFrame.to_string with a default RangeIndex. """
+    n_rows = len(columns[0])
+    index = [str(i) for i in range(n_rows)]
+    index_width = len(index[-1])
+    widths = [max(len(name), max(len(value) for value in values))
+              for name, values in zip(names, columns)]
+
+    lines = [" " * index_width + "".join(" " + name.rjust(width)
+                                         for name, width in zip(names, widths))]
+    for r in range(n_rows):
+        lines.append(index[r].ljust(index_width) +
+                     "".join(" " + values[r].rjust(width)
+                             for values, width in zip(columns, widths)))
+    return "\n".join(lines)